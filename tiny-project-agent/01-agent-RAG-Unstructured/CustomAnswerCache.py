@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+
+class SemanticAnswerCache:
+    """Answer cache looked up by question embedding instead of exact text.
+
+    A question whose cosine similarity to a cached question is >= threshold gets
+    the cached answer, without calling the chat model. Entries belong to one
+    corpus version and expire after `ttl` seconds. Entries are appended to a
+    jsonl file; the vectors are held in one normalized numpy matrix.
+    """
+
+    def __init__(self, path, embeddings, threshold=0.92, ttl=86400, max_entries=5000):
+        self.path = path
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = []
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._load()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self._entries.append(json.loads(line))
+                except ValueError:
+                    continue  # torn last line
+        self._compact(rewrite=False)
+
+    def _compact(self, rewrite=True):
+        now = time.time()
+        self._entries = [e for e in self._entries if e["expires"] > now][-self.max_entries:]
+        if self._entries:
+            self._matrix = np.array([e["vector"] for e in self._entries], dtype=np.float32)
+        else:  # everything expired: reshape(0, -1) of an empty array raises
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+        if rewrite:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for e in self._entries:
+                    f.write(json.dumps(e, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.path)
+
+    def lookup(self, question, version):
+        """Return (answer, similarity) of the closest cached question, or (None, similarity)."""
+        vector = self._normalize(self.embeddings.embed_query(question))
+        with self._lock:
+            if not len(self._entries):
+                self.misses += 1
+                return None, 0.0
+            sims = self._matrix @ vector
+            now = time.time()
+            valid = np.array([e["version"] == version and e["expires"] > now for e in self._entries])
+            sims = np.where(valid, sims, -1.0)
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                self.hits += 1
+                return self._entries[best]["answer"], float(sims[best])
+            self.misses += 1
+            return None, float(sims[best])
+
+    def store(self, question, answer, version):
+        vector = self._normalize(self.embeddings.embed_query(question))
+        entry = {
+            "question": question,
+            "answer": answer,
+            "version": version,
+            "expires": time.time() + self.ttl,
+            "vector": vector.tolist(),
+        }
+        with self._lock:
+            self._entries.append(entry)
+            if len(self._entries) > self.max_entries * 1.2:
+                self._compact()
+                return
+            self._matrix = np.vstack([self._matrix.reshape(-1, len(vector)), vector[None, :]])
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
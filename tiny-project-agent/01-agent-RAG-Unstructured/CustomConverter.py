@@ -1,9 +1,16 @@
+import hashlib
+import json
+import os
+import time
 import requests
 from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import VlmPipelineOptions
+from docling.datamodel.settings import settings
+from docling.datamodel.pipeline_options import PdfPipelineOptions, VlmPipelineOptions
 from docling.datamodel.pipeline_options_vlm_model import ApiVlmOptions, ResponseFormat
 from docling.document_converter import DocumentConverter, PdfFormatOption, ImageFormatOption
 from docling.pipeline.vlm_pipeline import VlmPipeline
+from docling_core.types.doc import DoclingDocument
+import pypdfium2 as pdfium
 from LLM import vl_llm
 
 
@@ -11,6 +18,13 @@ from LLM import vl_llm
 # BASE_URL = 
 # API_KEY = vl_llm.openai_api_key    # not needed for local deploy model
 # MODEL_ID = vl_llm.model_name
+# max pages sent to the VLM server at the same time (match the server's parallel slots)
+VL_CONCURRENCY = int(os.getenv("VL_CONCURRENCY", 4))
+# a PDF page with fewer extractable characters than this is treated as scanned
+MIN_TEXT_CHARS = int(os.getenv("MIN_TEXT_CHARS", 20))
+# converted documents are cached here, least recently used entries are evicted above the size limit
+CONVERT_CACHE_DIR = os.getenv("CONVERT_CACHE_DIR", "convert_cache")
+CONVERT_CACHE_MAX_MB = float(os.getenv("CONVERT_CACHE_MAX_MB", 1024))
 
 # perpare LM studio
 def check_LM_studio(key_word="vl"):
@@ -28,10 +42,14 @@ pipeline_options.vlm_options = ApiVlmOptions(
     headers={"Authorization":f"Bearer {vl_llm.openai_api_key}"} if vl_llm.openai_api_key else {},
     prompt="Please convert this document page to clean markdown format. Extract all text, tables, and structure accurately.",
     temperature=0.1,
-    response_format=ResponseFormat.MARKDOWN  # 使用具体的枚举值
+    response_format=ResponseFormat.MARKDOWN,  # 使用具体的枚举值
+    concurrency=VL_CONCURRENCY,  # pages of one batch are requested in parallel, results keep page order
 )
+# VlmPipeline hands pages to the model in batches of page_batch_size,
+# so a batch must be at least as large as the in-flight limit to fill all slots
+settings.perf.page_batch_size = max(settings.perf.page_batch_size, VL_CONCURRENCY)
 # 1.2 create converter
-converter = DocumentConverter(
+vlm_converter = DocumentConverter(
     allowed_formats=[
         InputFormat.MD,InputFormat.PDF,InputFormat.IMAGE,
         InputFormat.DOCX,InputFormat.XLSX,InputFormat.PPTX
@@ -49,9 +67,219 @@ converter = DocumentConverter(
         # other formats will use standard processing
     }
 )
+# born-digital PDF pages: standard pipeline reads the text layer, no OCR / VLM needed
+text_pipeline_options = PdfPipelineOptions(do_ocr=False)
+text_converter = DocumentConverter(
+    allowed_formats=[InputFormat.PDF],
+    format_options={
+        InputFormat.PDF: PdfFormatOption(pipeline_options=text_pipeline_options),
+    }
+)
+
+# 2. route PDF pages by text layer
+def pages_with_text_layer(path, min_chars=MIN_TEXT_CHARS):
+    """Return one bool per page: True if the page has an extractable text layer."""
+    pdf = pdfium.PdfDocument(path)
+    try:
+        flags = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            flags.append(len(textpage.get_text_range().strip()) >= min_chars)
+            textpage.close()
+            page.close()
+        return flags
+    finally:
+        pdf.close()
+
+def page_runs(flags):
+    """Group consecutive pages with the same flag: [(has_text, first_page, last_page)], 1-based."""
+    runs = []
+    for page_no, flag in enumerate(flags, start=1):
+        if runs and runs[-1][0] == flag:
+            runs[-1][2] = page_no
+        else:
+            runs.append([flag, page_no, page_no])
+    return [tuple(r) for r in runs]
+
+class TextLayerRouter:
+    """DocumentConverter look-alike: only scanned PDF pages (and images) go to the VLM."""
+
+    def __init__(self, vlm_converter, text_converter):
+        self.vlm_converter = vlm_converter
+        self.text_converter = text_converter
+
+    @property
+    def allowed_formats(self):
+        return self.vlm_converter.allowed_formats
+
+    def initialize_pipeline(self, format):
+        self.vlm_converter.initialize_pipeline(format)
+        if format == InputFormat.PDF:
+            self.text_converter.initialize_pipeline(format)
+
+    def convert(self, source, **kwargs):
+        if not (isinstance(source, (str, os.PathLike)) and str(source).lower().endswith(".pdf")):
+            return self.vlm_converter.convert(source, **kwargs)
+        runs = page_runs(pages_with_text_layer(source))
+        if len(runs) <= 1:
+            has_text = runs[0][0] if runs else True
+            return (self.text_converter if has_text else self.vlm_converter).convert(source, **kwargs)
+        # mixed PDF: convert each run of pages with its own pipeline, then stitch in page order
+        results = [
+            (self.text_converter if has_text else self.vlm_converter).convert(
+                source, page_range=(first, last), **kwargs
+            )
+            for has_text, first, last in runs
+        ]
+        res = results[0]
+        res.document = DoclingDocument.concatenate([r.document for r in results])
+        return res
+
+# 3. cache converted documents on disk
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def converter_fingerprint():
+    """Hash of every setting that changes conversion output (not concurrency / credentials)."""
+    config = {
+        "vlm_model": vl_llm.model_name,
+        "vlm_options": pipeline_options.vlm_options.model_dump(exclude={"headers", "concurrency", "timeout"}),
+        "vlm_pipeline": pipeline_options.model_dump(exclude={"vlm_options"}),
+        "text_pipeline": text_pipeline_options.model_dump(),
+        "min_text_chars": MIN_TEXT_CHARS,
+    }
+    data = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class ConversionCache:
+    """On-disk LRU cache of DoclingDocument JSON (+ markdown) keyed by file hash and converter config.
+
+    Each entry stores the sha256 of its JSON in a meta file, so a hit is verified
+    before use and a corrupted entry is dropped instead of returned.
+    """
+
+    def __init__(self, directory=CONVERT_CACHE_DIR, max_mb=CONVERT_CACHE_MAX_MB):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _write(self, path, data):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _load(self, key):
+        try:
+            with open(self._path(key, ".meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(self._path(key, ".json"), "rb") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        if hashlib.sha256(data).hexdigest() != meta.get("doc_sha256"):
+            print(f"convert cache entry {key} is corrupted, dropping it")
+            self.remove(key)
+            return None
+        return data
+
+    def get(self, key):
+        data = self._load(key)
+        if data is None:
+            self.misses += 1
+            return None
+        os.utime(self._path(key, ".meta.json"))  # mark as recently used
+        self.hits += 1
+        return DoclingDocument.model_validate_json(data)
+
+    def put(self, key, document, **meta):
+        data = document.model_dump_json().encode("utf-8")
+        self._write(self._path(key, ".json"), data)
+        self._write(self._path(key, ".md"), document.export_to_markdown().encode("utf-8"))
+        meta.update(doc_sha256=hashlib.sha256(data).hexdigest(), created=time.time())
+        # meta is written last: an entry without meta is never read
+        self._write(self._path(key, ".meta.json"), json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        self.evict()
+
+    def remove(self, key):
+        for suffix in (".meta.json", ".json", ".md"):
+            try:
+                os.remove(self._path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """[(last_used, size_bytes, key)] for every complete entry."""
+        items = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(".meta.json"):
+                continue
+            key = fname[:-len(".meta.json")]
+            try:
+                last_used = os.path.getmtime(self._path(key, ".meta.json"))
+                size = sum(os.path.getsize(self._path(key, sfx)) for sfx in (".meta.json", ".json", ".md"))
+            except OSError:
+                continue
+            items.append((last_used, size, key))
+        return items
+
+    def evict(self):
+        items = sorted(self.entries())
+        total = sum(size for _, size, _ in items)
+        for _, size, key in items:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def verify(self):
+        """Check every entry's hash, drop corrupted ones, return (n_ok, n_bad)."""
+        results = [self._load(key) is not None for _, _, key in self.entries()]
+        return sum(results), len(results) - sum(results)
+
+class CachedConversionResult:
+    def __init__(self, document, input_path):
+        self.document = document
+        self.input_path = input_path
+
+class CachedConverter:
+    """Wrap a converter so each file is converted (and sent to the VLM) only once per config."""
+
+    def __init__(self, converter, cache):
+        self.converter = converter
+        self.cache = cache
+        self.fingerprint = converter_fingerprint()
+
+    def __getattr__(self, name):
+        # allowed_formats, initialize_pipeline ... come from the wrapped converter
+        return getattr(self.converter, name)
+
+    def convert(self, source, **kwargs):
+        if kwargs or not isinstance(source, (str, os.PathLike)):
+            return self.converter.convert(source, **kwargs)
+        content_hash = file_hash(source)
+        key = hashlib.sha256(f"{content_hash}:{self.fingerprint}".encode("utf-8")).hexdigest()
+        document = self.cache.get(key)
+        if document is not None:
+            return CachedConversionResult(document, source)
+        res = self.converter.convert(source)
+        self.cache.put(key, res.document, source=str(source), file_hash=content_hash, fingerprint=self.fingerprint)
+        return res
+
+converter = CachedConverter(TextLayerRouter(vlm_converter, text_converter), ConversionCache())
 
 if __name__ == "__main__":
     check_LM_studio()
+    print("convert cache (ok, corrupted):", converter.cache.verify())
 
     # res = converter.convert('./docs/monthly_sales_data.xlsx')
     # res = converter.convert('./docs/sales_strategy_report.docx')
@@ -0,0 +1,166 @@
+import json
+import os
+import re
+import threading
+import zlib
+from collections import defaultdict
+import numpy as np
+
+DEDUP_FILE = "dedup_index.npz"
+# chunks whose estimated Jaccard similarity (of character shingles) is at least this, and whose
+# numbers are identical, are duplicates; 0 = off
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.85))
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+# 16 bands x 8 rows: pairs above ~0.7 similarity almost always share a band
+LSH_BANDS = 16
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_SPACE_RE = re.compile(r"\s+")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+
+def shingles(text, size=SHINGLE_SIZE):
+    text = _SPACE_RE.sub(" ", text.lower()).strip()
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+def numbers_key(text):
+    """crc32 of the text's numbers in order: chunks that differ in a price or a date are never duplicates."""
+    return zlib.crc32("\x00".join(_NUMBER_RE.findall(text)).encode("utf-8"))
+
+def minhash(text):
+    """MinHash signature (NUM_PERM uint32) of the text's character shingles."""
+    # crc32 is stable across processes, unlike hash()
+    x = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles(text)), dtype=np.uint64)
+    hashed = (_PERM_A[:, None] * x[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return (hashed.min(axis=1) & 0xFFFFFFFF).astype(np.uint32)
+
+class DedupIndex:
+    """MinHash LSH over every kept chunk, persisted next to the collection.
+
+    A chunk that is a near-duplicate of a kept chunk (similar text and the very
+    same numbers, see numbers_key) is not embedded or stored;
+    the kept chunk records where its copies came from (provenance), and the
+    manifest entry of the dropped chunk points at the kept one ("dup_of").
+    The ingest saves it after every finished file, so a resumed run never
+    matches chunks against signatures of chunks it has already deleted.
+    """
+
+    def __init__(self, path, threshold=DEDUP_THRESHOLD, bands=LSH_BANDS):
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = NUM_PERM // bands
+        self.signatures = {}  # id -> signature
+        self.sources = {}  # id -> source of the kept chunk
+        self.numbers = {}  # id -> numbers_key of the kept chunk, None if unknown (older index files)
+        self.provenance = defaultdict(list)  # kept id -> [[source, start_index], ...] of dropped copies
+        self.buckets = defaultdict(set)  # (band, band bytes) -> ids
+        self._lock = threading.Lock()  # split adds while upsert saves, in different pipeline threads
+
+    @classmethod
+    def load(cls, directory):
+        index = cls(os.path.join(directory, DEDUP_FILE))
+        if os.path.isfile(index.path):
+            data = np.load(index.path)
+            numbers = data["numbers"].tolist() if "numbers" in data else [-1] * len(data["ids"])
+            numbers = [None if key == -1 else key for key in numbers]
+            for doc_id, source, sig, key in zip(data["ids"].tolist(), data["sources"].tolist(),
+                                                data["signatures"], numbers):
+                index._add(doc_id, source, sig, key)
+            for doc_id, copies in json.loads(str(data["provenance"])).items():
+                index.provenance[doc_id] = copies
+        return index
+
+    def save(self):
+        with self._lock:
+            ids = list(self.signatures)
+            signatures = np.array([self.signatures[i] for i in ids], dtype=np.uint32).reshape(len(ids), NUM_PERM)
+            sources = np.array([self.sources[i] for i in ids], dtype=str)
+            # an unknown key (-1) never equals a crc32, so such a chunk is never a match
+            numbers = np.array([-1 if self.numbers[i] is None else self.numbers[i] for i in ids], dtype=np.int64)
+            provenance = json.dumps(self.provenance, ensure_ascii=False)
+        tmp = self.path + ".tmp.npz"
+        np.savez(
+            tmp,
+            ids=np.array(ids, dtype=str),
+            sources=sources,
+            signatures=signatures,
+            numbers=numbers,
+            provenance=np.array(provenance),
+        )
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _band_keys(self, sig):
+        return [(b, sig[b * self.rows:(b + 1) * self.rows].tobytes()) for b in range(self.bands)]
+
+    def _add(self, doc_id, source, sig, numbers):
+        self.signatures[doc_id] = sig
+        self.sources[doc_id] = source
+        self.numbers[doc_id] = numbers
+        for key in self._band_keys(sig):
+            self.buckets[key].add(doc_id)
+
+    def find(self, sig, numbers):
+        """Id of the most similar kept chunk with the same numbers at or above the threshold, else None."""
+        candidates = set()
+        for key in self._band_keys(sig):
+            candidates |= self.buckets.get(key, set())
+        best, best_sim = None, self.threshold
+        for doc_id in candidates:
+            if self.numbers[doc_id] != numbers:
+                continue
+            sim = float(np.mean(self.signatures[doc_id] == sig))
+            if sim >= best_sim:
+                best, best_sim = doc_id, sim
+        return best
+
+    def dedup(self, ids, docs):
+        """Split one file's chunks into kept docs and {dropped id: kept id}.
+
+        Kept chunks are added to the index, so later chunks (of this or any
+        other file) are compared against them.
+        """
+        kept, dup_of = [], {}
+        signatures = [minhash(doc.page_content) for doc in docs]
+        numbers = [numbers_key(doc.page_content) for doc in docs]
+        with self._lock:
+            for doc_id, doc, sig, key in zip(ids, docs, signatures, numbers):
+                match = self.find(sig, key) if self.threshold > 0 else None
+                if match is None or match == doc_id:
+                    self._add(doc_id, doc.metadata["source"], sig, key)
+                    kept.append(doc)
+                else:
+                    dup_of[doc_id] = match
+                    self.provenance[match].append([doc.metadata["source"], doc.metadata.get("start_index", -1)])
+        return kept, dup_of
+
+    def remove_source(self, source):
+        """Forget the source's kept chunks and its entries in other chunks' provenance."""
+        with self._lock:
+            self._remove_source(source)
+
+    def _remove_source(self, source):
+        for doc_id in [i for i, s in self.sources.items() if s == source]:
+            sig = self.signatures.pop(doc_id)
+            self.sources.pop(doc_id)
+            self.numbers.pop(doc_id)
+            self.provenance.pop(doc_id, None)
+            for key in self._band_keys(sig):
+                self.buckets[key].discard(doc_id)
+        for doc_id in list(self.provenance):
+            copies = [c for c in self.provenance[doc_id] if c[0] != source]
+            if copies:
+                self.provenance[doc_id] = copies
+            else:
+                del self.provenance[doc_id]
+
+    def copies_of(self, doc_id):
+        """[[source, start_index], ...] of the near-duplicates dropped in favour of this chunk."""
+        return self.provenance.get(doc_id, [])
@@ -0,0 +1,753 @@
+import json
+import os
+import re
+import threading
+import uuid
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, one process per store directory
+    fcntl = None
+
+# rows scored per matmul block, keeps float16 -> float32 upcasts small
+SEARCH_BLOCK_ROWS = 65536
+# quantized search keeps k * factor candidates for exact float re-scoring
+RERANK_FACTOR = {"int8": 4, "binary": 20}
+# metadata fields kept as a column of value codes, a filter on them is one vectorized scan
+INDEXED_FIELDS = ("source", "file_type", "page", "headings")
+# ids are stored fixed-width, the width grows in steps of this many bytes when a longer id arrives
+ID_WIDTH_STEP = 16
+# live rows are copied into a new generation once this share of all rows is deleted
+COMPACT_DELETED_RATIO = 0.25
+# rows read and written per block while compacting
+COMPACT_BLOCK_ROWS = 8192
+# files of the format that rewrote the whole store on every write, migrated on first open
+_LEGACY_SUFFIXES = ("vectors.npy", "docs.jsonl", "offsets.npy", "int8.npy", "binary.npy", "int8_scale.npy",
+                    "meta_index.json")
+
+def match_where(metadata, where):
+    """Chroma-style metadata filter: {"k": v}, {"k": {"$eq"/"$ne"/"$in"/"$nin": ...}}, {"$and"/"$or": [...]}."""
+    if not where:
+        return True
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(match_where(metadata, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(match_where(metadata, c) for c in cond):
+                return False
+        elif isinstance(cond, dict):
+            value = metadata.get(key)
+            for op, arg in cond.items():
+                compare = {
+                    "$eq": lambda: value == arg,
+                    "$ne": lambda: value != arg,
+                    "$in": lambda: value in arg,
+                    "$nin": lambda: value not in arg,
+                    "$gt": lambda: value is not None and value > arg,
+                    "$gte": lambda: value is not None and value >= arg,
+                    "$lt": lambda: value is not None and value < arg,
+                    "$lte": lambda: value is not None and value <= arg,
+                }.get(op)
+                if compare is None:
+                    raise ValueError(f"unsupported operator {op}")
+                ok = compare()
+                if not ok:
+                    return False
+        elif metadata.get(key) != cond:
+            return False
+    return True
+
+class _FlatCollection:
+    """The subset of chromadb.Collection used by this project (count/get/upsert/delete)."""
+
+    def __init__(self, store):
+        self._store = store
+        self.name = store.collection_name
+        self.id = store.collection_name
+
+    def count(self):
+        return self._store.count()
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas")):
+        store = self._store
+        view = store._sync()
+        if ids is None:
+            rows = store._filtered_rows(view, where) if where else np.flatnonzero(view["live"])
+        else:
+            rows = store._rows_of(view, ids)
+            if where:
+                rows = np.array([r for r, rec in zip(rows, store._read_rows(view, rows))
+                                 if match_where(rec["metadata"], where)], dtype=np.int64)
+        rows = rows[offset or 0:] if limit is None else rows[offset or 0:][:limit]
+        result = {"ids": store._ids_at(view, rows)}
+        if "documents" in include or "metadatas" in include:
+            records = store._read_rows(view, rows)
+            if "documents" in include:
+                result["documents"] = [rec["text"] for rec in records]
+            if "metadatas" in include:
+                result["metadatas"] = [rec["metadata"] for rec in records]
+        if "embeddings" in include:
+            result["embeddings"] = np.asarray(view["vectors"][rows], dtype=np.float32)
+        return result
+
+    def upsert(self, ids, embeddings, documents, metadatas=None):
+        metadatas = metadatas or [{} for _ in ids]
+        self._store._upsert(ids, embeddings, documents, metadatas)
+
+    def delete(self, ids=None, where=None):
+        self._store.delete(ids=ids, where=where)
+
+class FlatVectorStore(VectorStore):
+    """Exact (brute force) vector store in memory-mapped numpy files.
+
+    Vectors are L2-normalized, so search is one matmul plus argpartition.
+    Chunk text and metadata live in a jsonl file with a row -> byte offset
+    table, so a search only reads the k rows it returns.
+    Scores are cosine distances (smaller is more similar), like Chroma.
+
+    Writes only append: an upsert appends rows and tombstones the rows of the
+    ids it replaces, a delete appends tombstones. A small manifest, replaced
+    atomically after the data is on disk, says how many rows, bytes and
+    tombstones are valid; a crashed write leaves a tail that the next write
+    cuts off. Once tombstones reach COMPACT_DELETED_RATIO of the rows, the
+    live rows are copied into a new generation of files. The row -> id map is
+    a fixed-width byte array and every INDEXED_FIELDS value an int32 code per
+    row (the codes are listed in vocab.jsonl), all memory-mapped: opening the
+    store reads the manifest, the tombstones and the vocabulary, nothing per
+    row; the id -> row dict is only built on the first lookup by id.
+    Every call first compares the manifest's inode/mtime/size with the one
+    its caches were built from and reads only what was appended since, so a
+    serving process follows an ingest running in another process.
+
+    With quantization="int8" (per-dimension scalar codes, 4x smaller) or
+    "binary" (sign bits, 32x smaller, Hamming distance), the scan runs over
+    the codes and only a small candidate set is re-scored against the float
+    vectors, which stay on disk behind the memory map.
+    """
+
+    def __init__(self, directory, embedding_function, collection_name="db1", dtype="float32",
+                 quantization="none", rerank_factor=None):
+        self.directory = directory
+        self.collection_name = collection_name
+        self.embedding_function = embedding_function
+        self.dtype = np.dtype(dtype)
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor or RERANK_FACTOR.get(quantization, 1)
+        self.manifest_path = os.path.join(directory, f"flat_{collection_name}_manifest.json")
+        self.lock_path = os.path.join(directory, f"flat_{collection_name}.lock")
+        self._collection = _FlatCollection(self)
+        self._mutex = threading.RLock()
+        self._view = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _reset_cache(self):
+        # the next call re-reads the manifest; an unchanged generation is still extended, not reloaded
+        view = self._view
+        if view is not None:
+            self._view = dict(view, stamp=False)
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    # ---- storage ----
+    def _path(self, generation, suffix):
+        return os.path.join(self.directory, f"flat_{self.collection_name}_g{generation}_{suffix}")
+
+    def _empty_manifest(self):
+        return {"generation": 0, "dtype": self.dtype.name, "dim": 0, "rows": 0,
+                "docs_bytes": 0, "id_width": ID_WIDTH_STEP, "vocab_bytes": 0, "deleted": 0}
+
+    def _read_manifest(self):
+        """(last committed manifest, identity of its file), an empty store has no manifest file."""
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                st = os.fstat(f.fileno())
+                return json.load(f), (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return self._empty_manifest(), None
+
+    def _commit(self, manifest):
+        tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+
+    def _locked(self):
+        """The store's lock file, exclusively locked until closed: one writer across processes."""
+        f = open(self.lock_path, "a")
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def _sync(self):
+        """View of the last committed state, refreshed only when the manifest file changed."""
+        try:
+            st = os.stat(self.manifest_path)
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        view = self._view
+        if view is not None and view["stamp"] == stamp:
+            return view
+        with self._mutex:
+            if self._view is not None and self._view["stamp"] == stamp:
+                return self._view
+            if stamp is None and os.path.isfile(self._legacy_path("vectors.npy")):
+                with self._locked():
+                    if not os.path.isfile(self.manifest_path):
+                        self._migrate_legacy()
+            manifest, stamp = self._read_manifest()
+            if "ids_bytes" in manifest:  # ids.jsonl layout, parsed in full on every open
+                with self._locked():
+                    if "ids_bytes" in self._read_manifest()[0]:
+                        self._upgrade(self._read_manifest()[0])
+                manifest, stamp = self._read_manifest()
+            self._view = self._refresh(manifest, stamp)
+            return self._view
+
+    def _map(self, generation, suffix, dtype, shape):
+        """Read-only memory map of a generation file, an empty array while there are no rows."""
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._path(generation, suffix), dtype=dtype, mode="r", shape=shape)
+
+    def _refresh(self, manifest, stamp):
+        """Extend the current view by the rows and tombstones appended since, or load a new generation."""
+        old = self._view
+        if old is None or old["manifest"]["generation"] != manifest["generation"] \
+                or old["manifest"]["rows"] > manifest["rows"]:
+            vocab, row_of, live = {}, None, np.zeros(0, dtype=bool)
+            vocab_bytes, n_deleted, n_known = 0, 0, 0
+        else:
+            # vocab / row_of are shared with older views, which only use rows and codes they know
+            vocab, row_of, live = old["vocab"], old["row_of"], old["live"]
+            vocab_bytes, n_deleted, n_known = (old["manifest"]["vocab_bytes"], old["manifest"]["deleted"],
+                                               old["manifest"]["rows"])
+        generation, n_rows, width = manifest["generation"], manifest["rows"], manifest["id_width"]
+        dead = np.zeros(0, dtype=np.int64)
+        if manifest["vocab_bytes"] > vocab_bytes:
+            with open(self._path(generation, "vocab.jsonl"), "rb") as f:
+                f.seek(vocab_bytes)
+                for line in f.read(manifest["vocab_bytes"] - vocab_bytes).splitlines():
+                    field, value = json.loads(line)
+                    codes = vocab.setdefault(field, {})
+                    codes[value] = len(codes)
+        if manifest["deleted"] > n_deleted:
+            with open(self._path(generation, "deleted.bin"), "rb") as f:
+                f.seek(n_deleted * 8)
+                dead = np.frombuffer(f.read((manifest["deleted"] - n_deleted) * 8), dtype=np.int64)
+        live = np.concatenate([live, np.ones(n_rows - len(live), dtype=bool)])  # a copy, older views keep theirs
+        live[dead] = False
+        ids = self._map(generation, f"ids{width}.bin", f"S{width}", (n_rows,))
+        if row_of is not None:
+            row_of.update(zip(ids[n_known:].tolist(), range(n_known, n_rows)))
+        dtype, dim = np.dtype(manifest["dtype"]), manifest["dim"]
+        return {
+            "stamp": stamp,
+            "manifest": manifest,
+            "ids": ids,
+            "row_of": row_of,
+            "vocab": vocab,
+            "columns": {field: self._map(generation, f"meta_{field}.bin", np.int32, (n_rows,))
+                        for field in INDEXED_FIELDS},
+            "live": live,
+            "vectors": self._map(generation, "vectors.bin", dtype, (n_rows, dim)),
+            "offsets": self._map(generation, "offsets.bin", np.int64, (n_rows,)),
+            "codes": {},
+        }
+
+    def _truncate(self, manifest):
+        """Cut off whatever a crashed write appended after the last commit (lock held)."""
+        generation, n_rows = manifest["generation"], manifest["rows"]
+        sizes = {
+            "vectors.bin": n_rows * manifest["dim"] * np.dtype(manifest["dtype"]).itemsize,
+            "docs.jsonl": manifest["docs_bytes"],
+            "offsets.bin": n_rows * 8,
+            f"ids{manifest['id_width']}.bin": n_rows * manifest["id_width"],
+            "vocab.jsonl": manifest["vocab_bytes"],
+            "deleted.bin": manifest["deleted"] * 8,
+            **{f"meta_{field}.bin": n_rows * 4 for field in INDEXED_FIELDS},
+        }
+        for mode in RERANK_FACTOR:
+            width = self._code_width(mode, manifest["dim"])
+            path = self._path(generation, f"{mode}.bin")
+            if width and os.path.isfile(path):
+                sizes[f"{mode}.bin"] = min(os.path.getsize(path) // width, n_rows) * width
+        for suffix, size in sizes.items():
+            path = self._path(generation, suffix)
+            if os.path.isfile(path) and os.path.getsize(path) > size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    @staticmethod
+    def _append_bytes(path, data, sync=True):
+        with open(path, "ab") as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _widen_ids(self, manifest, width):
+        """Copy the ids to a wider file (lock held); readers of the committed manifest keep the old one."""
+        generation, n_rows, old_width = manifest["generation"], manifest["rows"], manifest["id_width"]
+        ids = np.fromfile(self._path(generation, f"ids{old_width}.bin"), dtype=f"S{old_width}", count=n_rows) \
+            if n_rows else np.zeros(0, dtype=f"S{old_width}")
+        ids.astype(f"S{width}").tofile(self._path(generation, f"ids{width}.bin"))
+        manifest["id_width"] = width
+
+    def _append_rows(self, manifest, vocab, records, vectors, sync=True):
+        """Append records and their vectors to the manifest's generation and count them in the
+        manifest, which the caller commits (lock held). New metadata values are added to vocab."""
+        generation = manifest["generation"]
+        ids = [rec["id"].encode("utf-8") for rec in records]
+        longest = max(len(i) for i in ids)
+        if longest > manifest["id_width"]:
+            self._widen_ids(manifest, -(-longest // ID_WIDTH_STEP) * ID_WIDTH_STEP)
+        docs, offsets, docs_bytes = [], [], manifest["docs_bytes"]
+        for rec in records:
+            line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+            offsets.append(docs_bytes)
+            docs_bytes += len(line)
+            docs.append(line)
+        new_values, columns = [], {}
+        for field in INDEXED_FIELDS:
+            codes = vocab.setdefault(field, {})
+            column = np.full(len(records), -1, dtype=np.int32)  # -1: the row has no such field
+            for j, rec in enumerate(records):
+                if field in rec["metadata"]:
+                    value = json.dumps(rec["metadata"][field], ensure_ascii=False)
+                    if value not in codes:
+                        codes[value] = len(codes)
+                        new_values.append((json.dumps([field, value], ensure_ascii=False) + "\n").encode("utf-8"))
+                    column[j] = codes[value]
+            columns[field] = column
+        docs, new_values = b"".join(docs), b"".join(new_values)
+        files = {
+            "vectors.bin": np.asarray(vectors, dtype=manifest["dtype"]).tobytes(),
+            "docs.jsonl": docs,
+            "offsets.bin": np.asarray(offsets, dtype=np.int64).tobytes(),
+            f"ids{manifest['id_width']}.bin": np.array(ids, dtype=f"S{manifest['id_width']}").tobytes(),
+            "vocab.jsonl": new_values,
+            **{f"meta_{field}.bin": column.tobytes() for field, column in columns.items()},
+        }
+        for suffix, data in files.items():
+            self._append_bytes(self._path(generation, suffix), data, sync)
+        manifest["rows"] += len(records)
+        manifest["docs_bytes"] += len(docs)
+        manifest["vocab_bytes"] += len(new_values)
+
+    def _write_generation(self, generation, blocks, dtype, modes):
+        """Write a new generation from (records, vectors) blocks, return its manifest (not committed yet)."""
+        self._remove_generations(lambda g: g == generation)  # leftovers of a compaction that crashed
+        manifest = dict(self._empty_manifest(), generation=generation, dtype=np.dtype(dtype).name)
+        vocab = {}
+        for records, vectors in blocks:
+            if len(records):
+                manifest["dim"] = int(vectors.shape[1])
+                self._append_rows(manifest, vocab, records, vectors, sync=False)
+        prefix = f"flat_{self.collection_name}_g{generation}_"
+        for fname in os.listdir(self.directory):
+            if fname.startswith(prefix):
+                with open(os.path.join(self.directory, fname), "rb") as f:
+                    os.fsync(f.fileno())
+        for mode in modes:
+            self._extend_codes(manifest, mode)
+        return manifest
+
+    def _remove_generations(self, drop):
+        pattern = re.compile(rf"flat_{re.escape(self.collection_name)}_g(\d+)_")
+        for fname in os.listdir(self.directory):
+            found = pattern.match(fname)
+            if found and drop(int(found.group(1))):
+                os.remove(os.path.join(self.directory, fname))
+
+    def _replace_generation(self, blocks, dtype, modes):
+        """Commit a new generation built from blocks; the previous one stays for readers still using it."""
+        current = self._read_manifest()[0]["generation"]
+        self._commit(self._write_generation(current + 1, blocks, dtype, modes))
+        self._remove_generations(lambda g: g < current)
+
+    def _maybe_compact(self):
+        view = self._sync()
+        manifest = view["manifest"]
+        if manifest["deleted"] and manifest["deleted"] >= COMPACT_DELETED_RATIO * manifest["rows"]:
+            self._compact(view)
+
+    def _compact(self, view):
+        """Copy the live rows of the view into a new generation (lock held)."""
+        live = np.flatnonzero(view["live"])
+        generation = view["manifest"]["generation"]
+
+        def blocks():
+            for start in range(0, len(live), COMPACT_BLOCK_ROWS):
+                rows = live[start:start + COMPACT_BLOCK_ROWS]
+                yield self._read_rows(view, rows), view["vectors"][rows]
+
+        modes = [mode for mode in RERANK_FACTOR if os.path.isfile(self._path(generation, f"{mode}.bin"))]
+        self._replace_generation(blocks(), view["manifest"]["dtype"], modes)
+
+    def compact(self):
+        """Drop deleted rows from the files now instead of waiting for COMPACT_DELETED_RATIO."""
+        with self._mutex, self._locked():
+            view = self._sync()
+            if view["manifest"]["deleted"]:
+                self._compact(view)
+
+    def _upgrade(self, manifest):
+        """Copy a generation of the ids.jsonl layout into one of the current layout (lock held)."""
+        generation, n_rows = manifest["generation"], manifest["rows"]
+        print(f"flat index: rewriting {n_rows} rows of {self.directory} with a memory-mapped id map")
+        live = np.ones(n_rows, dtype=bool)
+        if manifest["deleted"]:
+            live[np.fromfile(self._path(generation, "deleted.bin"), dtype=np.int64, count=manifest["deleted"])] = False
+        self._compact({
+            "manifest": manifest,
+            "live": live,
+            "vectors": self._map(generation, "vectors.bin", np.dtype(manifest["dtype"]), (n_rows, manifest["dim"])),
+            "offsets": self._map(generation, "offsets.bin", np.int64, (n_rows,)),
+        })
+
+    def _legacy_path(self, suffix):
+        return os.path.join(self.directory, f"flat_{self.collection_name}_{suffix}")
+
+    def _migrate_legacy(self):
+        """Move a store of the old rewrite-everything format into generation 1 (lock held)."""
+        vectors = np.load(self._legacy_path("vectors.npy"), mmap_mode="r")
+        with open(self._legacy_path("docs.jsonl"), encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        print(f"flat index: migrating {len(records)} rows of {self.directory} to append-only files")
+        self._commit(self._write_generation(1, [(records, vectors)], vectors.dtype, []))
+        for suffix in _LEGACY_SUFFIXES:
+            if os.path.isfile(self._legacy_path(suffix)):
+                os.remove(self._legacy_path(suffix))
+
+    @staticmethod
+    def _code_width(mode, dim):
+        return (dim + 7) // 8 if mode == "binary" else dim
+
+    @staticmethod
+    def _encode(mode, vectors, scale=None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if mode == "binary":
+            return np.packbits(vectors > 0, axis=1)
+        # rows appended after the scale was fixed may exceed it, clipped until the next compaction
+        return np.clip(np.round(vectors / scale), -127, 127).astype(np.int8)
+
+    @staticmethod
+    def _int8_scale(vectors):
+        max_abs = np.zeros(vectors.shape[1], dtype=np.float32)
+        for start in range(0, vectors.shape[0], SEARCH_BLOCK_ROWS):
+            block = np.abs(np.asarray(vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32))
+            max_abs = np.maximum(max_abs, block.max(axis=0))
+        return np.maximum(max_abs, 1e-12) / 127
+
+    def _extend_codes(self, manifest, mode):
+        """Create or extend the codes file of `mode` to cover every row of the manifest (lock held)."""
+        generation, n_rows, dim = manifest["generation"], manifest["rows"], manifest["dim"]
+        path, scale_path = self._path(generation, f"{mode}.bin"), self._path(generation, "int8_scale.npy")
+        width = self._code_width(mode, dim)
+        done = os.path.getsize(path) // width if width and os.path.isfile(path) else 0
+        if done >= n_rows:
+            return
+        vectors = np.memmap(self._path(generation, "vectors.bin"), dtype=np.dtype(manifest["dtype"]), mode="r",
+                            shape=(n_rows, dim))
+        scale = None
+        if mode == "int8":
+            if done == 0 or not os.path.isfile(scale_path):
+                done, scale = 0, self._int8_scale(vectors)  # fixed for this generation from here on
+                tmp = scale_path + ".tmp.npy"
+                np.save(tmp, scale)
+                os.replace(tmp, scale_path)
+            else:
+                scale = np.load(scale_path)
+        with open(path, "r+b" if done else "wb") as f:
+            f.seek(done * width)
+            f.truncate()
+            for start in range(done, n_rows, SEARCH_BLOCK_ROWS):
+                f.write(self._encode(mode, vectors[start:min(start + SEARCH_BLOCK_ROWS, n_rows)], scale).tobytes())
+
+    def _quantized(self, view):
+        """(codes, int8 scale) covering the view's rows; the codes file is built on first use."""
+        mode = self.quantization
+        if mode in view["codes"]:
+            return view["codes"][mode]
+        manifest = view["manifest"]
+        generation, n_rows, width = manifest["generation"], manifest["rows"], self._code_width(mode, manifest["dim"])
+        path, scale_path = self._path(generation, f"{mode}.bin"), self._path(generation, "int8_scale.npy")
+        covered = os.path.getsize(path) // width if os.path.isfile(path) else 0
+        if covered < n_rows:
+            with self._mutex, self._locked():
+                current = self._read_manifest()[0]
+                if current["generation"] == generation:
+                    self._truncate(current)
+                    self._extend_codes(current, mode)
+            covered = os.path.getsize(path) // width if os.path.isfile(path) else 0
+        covered = min(covered, n_rows)
+        if mode == "int8":
+            scale = np.load(scale_path) if os.path.isfile(scale_path) else self._int8_scale(view["vectors"])
+        else:
+            scale = None
+        code_dtype = np.int8 if mode == "int8" else np.uint8
+        codes = np.memmap(path, dtype=code_dtype, mode="r", shape=(covered, width)) if covered \
+            else np.zeros((0, width), dtype=code_dtype)
+        if covered < n_rows:
+            # the generation was compacted away meanwhile, encode the rest in memory
+            codes = np.concatenate([codes, self._encode(mode, view["vectors"][covered:], scale)])
+        view["codes"][mode] = (codes, scale)
+        return codes, scale
+
+    def _read_rows(self, view, rows):
+        if not len(rows):
+            return []
+        offsets = view["offsets"]
+        records = []
+        with open(self._path(view["manifest"]["generation"], "docs.jsonl"), "rb") as f:
+            for r in rows:
+                f.seek(int(offsets[r]))
+                records.append(json.loads(f.readline()))
+        return records
+
+    def _row_of(self, view):
+        """id (utf-8 bytes) -> its newest row, built on the first lookup by id and extended by later views."""
+        if view["row_of"] is None:
+            with self._mutex:
+                if view["row_of"] is None:
+                    view["row_of"] = dict(zip(view["ids"].tolist(), range(view["manifest"]["rows"])))
+        return view["row_of"]
+
+    def _live_row(self, view, doc_id):
+        row = self._row_of(view).get(doc_id.encode("utf-8"))
+        return row if row is not None and row < view["manifest"]["rows"] and view["live"][row] else None
+
+    def _rows_of(self, view, ids):
+        """Live rows of the given ids, in order; unknown ids are skipped."""
+        rows = [r for r in (self._live_row(view, i) for i in ids) if r is not None]
+        return np.array(rows, dtype=np.int64)
+
+    @staticmethod
+    def _ids_at(view, rows):
+        return [i.decode("utf-8") for i in view["ids"][rows].tolist()]
+
+    def _index_rows(self, view, where):
+        """Rows allowed by the indexed equality / $in conditions of `where` (None if it has none),
+        plus whether those conditions were the whole filter."""
+        rows, complete = None, True
+        for key, cond in where.items():
+            if key == "$and":
+                for sub in cond:
+                    sub_rows, sub_complete = self._index_rows(view, sub)
+                    complete &= sub_complete
+                    if sub_rows is not None:
+                        rows = sub_rows if rows is None else np.intersect1d(rows, sub_rows)
+                continue
+            if key not in INDEXED_FIELDS or (isinstance(cond, dict) and not set(cond) <= {"$eq", "$in"}):
+                complete = False
+                continue
+            if not isinstance(cond, dict):
+                cond = {"$eq": cond}
+            for op, arg in cond.items():
+                values = [arg] if op == "$eq" else arg
+                codes = [view["vocab"].get(key, {}).get(json.dumps(v, ensure_ascii=False)) for v in values]
+                codes = [c for c in codes if c is not None]
+                key_rows = np.flatnonzero(np.isin(view["columns"][key], codes)) if codes else np.zeros(0, np.int64)
+                rows = key_rows if rows is None else np.intersect1d(rows, key_rows)
+        return rows, complete
+
+    def _filtered_rows(self, view, where):
+        rows, complete = self._index_rows(view, where)
+        if rows is None:
+            rows = np.flatnonzero(view["live"])
+        else:
+            # the index also lists deleted rows, and rows appended after this view
+            rows = rows[rows < view["manifest"]["rows"]]
+            rows = rows[view["live"][rows]]
+        if not complete:
+            # conditions the index cannot answer are checked on the remaining rows only
+            rows = np.array([r for r, rec in zip(rows, self._read_rows(view, rows)) if match_where(rec["metadata"], where)],
+                            dtype=np.int64)
+        return rows
+
+    @staticmethod
+    def _normalize(embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _upsert(self, ids, embeddings, texts, metadatas):
+        if not len(ids):
+            return
+        vectors = self._normalize(embeddings)
+        records = [{"id": i, "text": t, "metadata": m or {}} for i, t, m in zip(ids, texts, metadatas)]
+        with self._mutex, self._locked():
+            view = self._sync()
+            manifest = dict(view["manifest"])
+            self._truncate(manifest)
+            if not manifest["dim"]:
+                manifest["dim"] = int(vectors.shape[1])
+            elif vectors.shape[1] != manifest["dim"]:
+                raise ValueError(f"embedding dim {vectors.shape[1]} != index dim {manifest['dim']}")
+            # an upserted id tombstones its current row (or its earlier copy in this batch)
+            latest, dead = {}, []
+            for j, rec in enumerate(records):
+                previous = latest.get(rec["id"])
+                if previous is None:
+                    previous = self._live_row(view, rec["id"])
+                if previous is not None:
+                    dead.append(previous)
+                latest[rec["id"]] = manifest["rows"] + j
+            generation = manifest["generation"]
+            # a copy: values reach the shared vocabulary of readers only through the committed vocab.jsonl
+            vocab = {field: dict(codes) for field, codes in view["vocab"].items()}
+            self._append_rows(manifest, vocab, records, vectors)
+            if dead:
+                self._append_bytes(self._path(generation, "deleted.bin"), np.asarray(dead, dtype=np.int64).tobytes())
+            manifest["deleted"] += len(dead)
+            for mode in RERANK_FACTOR:  # codes already built for a mode are kept covering every row
+                if os.path.isfile(self._path(generation, f"{mode}.bin")):
+                    self._extend_codes(manifest, mode)
+            self._commit(manifest)
+            self._maybe_compact()
+
+    # ---- VectorStore API ----
+    def count(self):
+        manifest = self._sync()["manifest"]
+        return manifest["rows"] - manifest["deleted"]
+
+    def file_sizes(self):
+        """Bytes on disk of each file of the current generation, by suffix (vectors.bin, int8.bin ...)."""
+        prefix = f"flat_{self.collection_name}_g{self._sync()['manifest']['generation']}_"
+        return {fname[len(prefix):]: os.path.getsize(os.path.join(self.directory, fname))
+                for fname in os.listdir(self.directory) if fname.startswith(prefix)}
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        self._upsert(ids, self.embedding_function.embed_documents(texts), texts, metadatas)
+        return ids
+
+    def delete(self, ids=None, where=None, **kwargs):
+        if not ids and not where:
+            return
+        with self._mutex, self._locked():
+            view = self._sync()
+            manifest = dict(view["manifest"])
+            self._truncate(manifest)
+            dead = set(self._rows_of(view, ids or []).tolist())
+            if where:
+                dead.update(self._filtered_rows(view, where).tolist())
+            if not dead:
+                return
+            self._append_bytes(self._path(manifest["generation"], "deleted.bin"),
+                               np.array(sorted(dead), dtype=np.int64).tobytes())
+            manifest["deleted"] += len(dead)
+            self._commit(manifest)
+            self._maybe_compact()
+
+    def get_by_ids(self, ids, /):
+        view = self._sync()
+        return [Document(id=rec["id"], page_content=rec["text"], metadata=rec["metadata"])
+                for rec in self._read_rows(view, self._rows_of(view, ids))]
+
+    def _scores(self, view, query_vector, rows=None):
+        """Exact cosine similarity of the query against all live rows (or the given rows)."""
+        vectors = view["vectors"]
+        if rows is not None:
+            rows = np.sort(rows)  # sorted rows read the memory map sequentially
+            return vectors[rows].astype(np.float32) @ query_vector, rows
+        scores = np.empty(vectors.shape[0], dtype=np.float32)
+        for start in range(0, vectors.shape[0], SEARCH_BLOCK_ROWS):
+            block = vectors[start:start + SEARCH_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32, copy=False) @ query_vector
+        scores[~view["live"]] = -np.inf
+        return scores, np.arange(vectors.shape[0])
+
+    def _approx_scores(self, view, query_vector, rows=None):
+        """Scores over the quantized codes (all live rows or the given rows), higher is better."""
+        codes, scale = self._quantized(view)
+        if rows is not None:
+            rows = np.sort(rows)
+            codes = codes[rows]
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        if self.quantization == "binary":
+            query_bits = np.packbits(query_vector > 0)
+            for start in range(0, codes.shape[0], SEARCH_BLOCK_ROWS):
+                block = codes[start:start + SEARCH_BLOCK_ROWS]
+                scores[start:start + len(block)] = -np.bitwise_count(block ^ query_bits).sum(axis=1, dtype=np.int32)
+        else:
+            scaled_query = query_vector * scale
+            for start in range(0, codes.shape[0], SEARCH_BLOCK_ROWS):
+                block = codes[start:start + SEARCH_BLOCK_ROWS]
+                scores[start:start + len(block)] = block.astype(np.float32) @ scaled_query
+        if rows is None:
+            scores[~view["live"]] = -np.inf
+            rows = np.arange(codes.shape[0])
+        return scores, rows
+
+    @staticmethod
+    def _top(scores, k):
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top[np.isfinite(scores[top])]
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        view = self._sync()
+        if view["manifest"]["rows"] == view["manifest"]["deleted"]:
+            return []
+        query = self._normalize([embedding])[0]
+        # metadata filter narrows the candidate rows before any vector is scored
+        rows = self._filtered_rows(view, filter) if filter else None
+        if rows is not None and not len(rows):
+            return []
+        n_candidates = k * self.rerank_factor
+        if self.quantization == "none" or (rows is not None and len(rows) <= n_candidates):
+            scores, rows = self._scores(view, query, rows)
+        else:
+            # prefilter on the codes, then re-score the candidates exactly
+            approx, rows = self._approx_scores(view, query, rows)
+            scores, rows = self._scores(view, query, rows[self._top(approx, n_candidates)])
+        top = self._top(scores, k)
+        return [(Document(id=rec["id"], page_content=rec["text"], metadata=rec["metadata"]), float(1 - scores[i]))
+                for i, rec in zip(top, self._read_rows(view, rows[top]))]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def import_collection(self, collection, page_size=1000):
+        """Replace the store with every chunk (and its stored embedding) of a Chroma collection, no re-embedding."""
+        def blocks():
+            offset = 0
+            while True:
+                page = collection.get(limit=page_size, offset=offset, include=["documents", "metadatas", "embeddings"])
+                if not len(page["ids"]):
+                    break
+                records = [{"id": i, "text": t, "metadata": m or {}}
+                           for i, t, m in zip(page["ids"], page["documents"], page["metadatas"])]
+                yield records, self._normalize(page["embeddings"])
+                offset += len(page["ids"])
+
+        with self._mutex, self._locked():
+            self._sync()
+            self._replace_generation(blocks(), self.dtype, [self.quantization] if self.quantization != "none" else [])
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, persist_directory="flat_db", **kwargs):
+        store = cls(persist_directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
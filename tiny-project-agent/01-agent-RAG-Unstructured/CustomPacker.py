@@ -0,0 +1,66 @@
+import os
+import re
+from langchain_core.documents import Document
+
+# token budget of the context returned by retrieve_context
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", 3000))
+# metadata shown to the model, the rest (ingest_time, start_index ...) only costs tokens
+CONTEXT_METADATA = ("source", "page", "headings")
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+def estimate_tokens(text):
+    """Cheap token estimate: one per CJK character, one per ~4 other characters."""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def _merge(blocks):
+    """Merge same-source chunks whose start_index ranges overlap or touch, dropping the overlap."""
+    merged = []
+    for block in sorted(blocks, key=lambda b: (b["source"], b["start"])):
+        prev = merged[-1] if merged else None
+        if prev is not None and prev["source"] == block["source"] and block["start"] >= 0:
+            overlap = prev["start"] + len(prev["text"]) - block["start"]
+            # start_index is only trusted if the overlapping text really matches
+            if 0 <= overlap <= len(block["text"]) and prev["text"].endswith(block["text"][:overlap]):
+                prev["text"] += block["text"][overlap:]
+                prev["rank"] = min(prev["rank"], block["rank"])
+                continue
+            if overlap > len(block["text"]) and block["text"] in prev["text"]:
+                prev["rank"] = min(prev["rank"], block["rank"])
+                continue
+        merged.append(block)
+    return sorted(merged, key=lambda b: b["rank"])
+
+def pack_context(docs, max_tokens=CONTEXT_MAX_TOKENS):
+    """Turn ranked chunks into as few Source/Content blocks as possible within max_tokens.
+
+    Neighbouring chunks of one source become one block without the repeated
+    overlap; blocks keep the rank of their best chunk, and the last block that
+    does not fit is cut to the remaining budget. Returns the packed documents.
+    """
+    blocks = [
+        {
+            "source": doc.metadata.get("source", ""),
+            "start": doc.metadata.get("start_index", -1),
+            "text": doc.page_content,
+            "rank": rank,
+            "metadata": {k: doc.metadata[k] for k in CONTEXT_METADATA if doc.metadata.get(k) not in (None, "", -1)},
+        }
+        for rank, doc in enumerate(docs)
+    ]
+    packed, budget = [], max_tokens
+    for block in _merge(blocks):
+        tokens = estimate_tokens(block["text"]) + estimate_tokens(str(block["metadata"])) + 4
+        if tokens > budget:
+            # keep the head of the block, scaled to the tokens that are left
+            keep = int(len(block["text"]) * budget / tokens)
+            if keep < 100:
+                break
+            block["text"] = block["text"][:keep]
+            tokens = budget
+        packed.append(Document(page_content=block["text"], metadata=block["metadata"]))
+        budget -= tokens
+    return packed
+
+def serialize_context(docs):
+    return "\n\n".join(f"Source: {doc.metadata}\nContent: {doc.page_content}" for doc in docs)
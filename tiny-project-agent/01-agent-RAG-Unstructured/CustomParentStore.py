@@ -0,0 +1,69 @@
+import json
+import os
+import sqlite3
+import threading
+from langchain_core.documents import Document
+
+PARENT_STORE_FILE = "parents.sqlite"
+# children searched per parent returned, several children of one parent often rank together
+PARENT_FANOUT = int(os.getenv("PARENT_FANOUT", 4))
+
+class ParentStore:
+    """Key-value store of parent chunk text (INDEX_MODE=parent), next to the collection.
+
+    Only the small child chunks are embedded; their metadata carries parent_id,
+    and the parent text is read from here when a child is retrieved.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, PARENT_STORE_FILE)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        # opened on first use: chunk-mode databases never create the file
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS parents (id TEXT PRIMARY KEY, source TEXT, text TEXT, metadata TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS parents_source ON parents (source)")
+        return self._conn
+
+    def replace_source(self, source, ids, docs):
+        """Atomically swap the parents of one source file."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM parents WHERE source = ?", (source,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO parents VALUES (?, ?, ?, ?)",
+                [(i, source, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False)) for i, doc in zip(ids, docs)],
+            )
+
+    def remove_source(self, source):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM parents WHERE source = ?", (source,))
+
+    def get_many(self, ids):
+        """Documents for the given ids, in order; unknown ids are skipped."""
+        if not ids:
+            return []
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT id, text, metadata FROM parents WHERE id IN ({','.join('?' * len(ids))})", list(ids)
+            ).fetchall()
+        found = {i: Document(page_content=text, metadata=json.loads(meta)) for i, text, meta in rows}
+        return [found[i] for i in ids if i in found]
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
+
+def expand_to_parents(store, children, k):
+    """Map ranked child chunks to their first k distinct parents (ranked by best child)."""
+    parent_ids = []
+    for child in children:
+        parent_id = child.metadata.get("parent_id")
+        if parent_id and parent_id not in parent_ids:
+            parent_ids.append(parent_id)
+    return store.get_many(parent_ids[:k])
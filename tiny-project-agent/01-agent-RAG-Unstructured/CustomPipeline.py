@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+
+# marks the end of a stream between two stages
+_DONE = object()
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.units = 0  # e.g. chunks, counted with the `count` function of the stage
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    def report(self):
+        wall = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "units": self.units,
+            "busy_s": round(self.busy, 3),
+            "wall_s": round(wall, 3),
+            "items_per_s": round(self.items / self.busy, 2) if self.busy else None,
+            "units_per_s": round(self.units / self.busy, 2) if self.busy else None,
+        }
+
+class Pipeline:
+    """Run stages in threads connected by bounded queues.
+
+    The source iterable is the first stage; each added stage maps one item to one
+    result (None drops the item). A full queue blocks the producer, so at most
+    `maxsize` items wait between two stages and memory does not grow with the corpus.
+    """
+
+    def __init__(self, name, source, maxsize=4, count=None):
+        self.maxsize = maxsize
+        self.stages = [(StageStats(name), None, count)]
+        self.source = source
+        self._iter = None
+        self._error = None
+        self._stop = threading.Event()
+
+    def add(self, name, fn, count=None):
+        self.stages.append((StageStats(name), fn, count))
+        return self
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fail(self, e):
+        if self._error is None:
+            self._error = e
+        self._stop.set()
+
+    def _run_source(self, stats, count, out_q):
+        stats.started = time.perf_counter()
+        try:
+            self._iter = iter(self.source)
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                item = next(self._iter, _DONE)
+                stats.busy += time.perf_counter() - start
+                if item is _DONE:
+                    break
+                stats.items += 1
+                stats.units += count(item) if count else 1
+                if not self._put(out_q, item):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            # a failed later stage stops the source early: close it so its cleanup
+            # (e.g. cancelling queued conversions) runs now instead of at garbage collection
+            self._close_source()
+            stats.finished = time.perf_counter()
+            self._put(out_q, _DONE)
+
+    def _close_source(self):
+        close = getattr(self._iter, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except ValueError:
+            pass  # generator still running in the source thread, it closes itself when next() returns
+
+    def _run_stage(self, stats, fn, count, in_q, out_q):
+        stats.started = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = in_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                start = time.perf_counter()
+                result = fn(item)
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+                stats.units += count(item) if count else 1
+                if result is not None and out_q is not None and not self._put(out_q, result):
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            stats.finished = time.perf_counter()
+            if out_q is not None:
+                self._put(out_q, _DONE)
+
+    def run(self):
+        """Run to completion, re-raise the first stage error, return the per-stage report."""
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages[1:]]
+        stats, _, count = self.stages[0]
+        threads = [threading.Thread(target=self._run_source, args=(stats, count, queues[0]), daemon=True)]
+        for i, (stats, fn, count) in enumerate(self.stages[1:]):
+            out_q = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._run_stage, args=(stats, fn, count, queues[i], out_q), daemon=True))
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                while t.is_alive():
+                    t.join(timeout=0.5)
+        except KeyboardInterrupt:
+            self._stop.set()
+            self._close_source()
+            raise
+        if self._error is not None:
+            raise self._error
+        return [stats.report() for stats, _, _ in self.stages]
+
+def print_report(report):
+    print(f"{'stage':<10}{'items':>8}{'units':>8}{'busy_s':>10}{'wall_s':>10}{'items/s':>10}{'units/s':>10}")
+    for r in report:
+        print(f"{r['stage']:<10}{r['items']:>8}{r['units']:>8}{r['busy_s']:>10}{r['wall_s']:>10}"
+              f"{str(r['items_per_s']):>10}{str(r['units_per_s']):>10}")
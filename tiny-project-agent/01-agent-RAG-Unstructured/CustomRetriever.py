@@ -0,0 +1,447 @@
+import asyncio
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from CustomFlatIndex import match_where
+
+BM25_FILE = "bm25_index.json"
+# changes on every ingest, caches keyed on it never serve results of an older corpus
+CORPUS_VERSION_FILE = "corpus_version"
+# query variants searched concurrently per retrieval (0 = only the original query)
+MULTI_QUERY_N = int(os.getenv("MULTI_QUERY_N", 0))
+# metadata fields a retrieval filter may use (see compact_metadata) and the type of their values
+FILTER_FIELDS = {"source": str, "file_type": str, "page": int, "headings": str}
+# operators every vector backend (Chroma, flat) and the BM25 index understand
+FILTER_OPERATORS = ("$eq", "$ne", "$in", "$nin", "$gt", "$gte", "$lt", "$lte")
+# CJK has no spaces: index character unigrams + bigrams, latin text by words / numbers
+_TOKEN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+(?:\.[0-9]+)?")
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+def tokenize(text):
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+class BM25Index:
+    """Persistent inverted BM25 index kept next to the Chroma collection.
+
+    Only term frequencies and metadata are stored (chroma_db/bm25_index.json);
+    chunk text stays in Chroma and hits are fetched from there by id.
+    """
+
+    def __init__(self, path, k1=1.5, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # id -> {"tf": {term: n}, "len": n, "metadata": {...}}
+        self.postings = defaultdict(dict)  # term -> {id: tf}
+        self.total_len = 0
+
+    @classmethod
+    def load(cls, directory):
+        index = cls(os.path.join(directory, BM25_FILE))
+        if os.path.isfile(index.path):
+            with open(index.path, encoding="utf-8") as f:
+                for doc_id, doc in json.load(f)["docs"].items():
+                    index._index(doc_id, doc)
+        return index
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"docs": self.docs}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _index(self, doc_id, doc):
+        self.remove([doc_id])
+        self.docs[doc_id] = doc
+        self.total_len += doc["len"]
+        for term, n in doc["tf"].items():
+            self.postings[term][doc_id] = n
+
+    def add(self, ids, docs):
+        for doc_id, doc in zip(ids, docs):
+            tokens = tokenize(doc.page_content)
+            self._index(doc_id, {"tf": dict(Counter(tokens)), "len": len(tokens), "metadata": doc.metadata})
+
+    def remove(self, ids):
+        for doc_id in ids:
+            doc = self.docs.pop(doc_id, None)
+            if doc is None:
+                continue
+            self.total_len -= doc["len"]
+            for term in doc["tf"]:
+                self.postings[term].pop(doc_id, None)
+                if not self.postings[term]:
+                    del self.postings[term]
+
+    def remove_source(self, source):
+        self.remove([i for i, d in self.docs.items() if d["metadata"].get("source") == source])
+
+    def search(self, query, k=4, filter=None):
+        """Return [(id, score)] of the k best BM25 matches (whose metadata matches `filter`)."""
+        n_docs = len(self.docs)
+        if not n_docs:
+            return []
+        avg_len = self.total_len / n_docs
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                if filter and not match_where(self.docs[doc_id]["metadata"], filter):
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * self.docs[doc_id]["len"] / avg_len)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda x: -x[1])[:k]
+
+    def rebuild(self, db, page_size=500):
+        """Re-index every chunk of the Chroma collection."""
+        self.docs, self.postings, self.total_len = {}, defaultdict(dict), 0
+        offset = 0
+        while True:
+            page = db._collection.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+            if not page["ids"]:
+                break
+            for doc_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                tokens = tokenize(text)
+                self._index(doc_id, {"tf": dict(Counter(tokens)), "len": len(tokens), "metadata": metadata or {}})
+            offset += len(page["ids"])
+        self.save()
+
+def load_bm25_index(db, directory):
+    """Load the BM25 index of a collection, rebuilding it if it is missing or out of sync."""
+    index = BM25Index.load(directory)
+    if len(index) != db._collection.count():
+        print(f"BM25 index out of sync ({len(index)} vs {db._collection.count()} chunks), rebuilding")
+        index.rebuild(db)
+    return index
+
+def check_filter(filter):
+    """Raise ValueError unless `filter` only uses FILTER_FIELDS, FILTER_OPERATORS and values of the field's type.
+
+    The filter is written by the model; this turns a bad one into a message it
+    can correct instead of a KeyError / TypeError from deep inside a backend.
+    """
+    if not isinstance(filter, dict) or not filter:
+        raise ValueError(f"a filter is a non-empty object, got {filter!r}")
+    for key, cond in filter.items():
+        if key in ("$and", "$or"):
+            if not isinstance(cond, list) or not cond:
+                raise ValueError(f"{key} takes a non-empty list of filters, got {cond!r}")
+            for sub in cond:
+                check_filter(sub)
+            continue
+        if key not in FILTER_FIELDS:
+            raise ValueError(f"unknown filter field {key!r}, use one of {list(FILTER_FIELDS)}")
+        kind = FILTER_FIELDS[key]
+        for op, value in (cond.items() if isinstance(cond, dict) else [("$eq", cond)]):
+            if op not in FILTER_OPERATORS:
+                raise ValueError(f"unsupported operator {op!r} on {key!r}, use one of {list(FILTER_OPERATORS)}")
+            if op in ("$gt", "$gte", "$lt", "$lte") and kind is not int:
+                raise ValueError(f"{op} needs a numeric field, {key!r} is text")
+            if op in ("$in", "$nin") and (not isinstance(value, list) or not value):
+                raise ValueError(f"{op} takes a non-empty list, got {value!r}")
+            for v in (value if op in ("$in", "$nin") else [value]):
+                if isinstance(v, bool) or not isinstance(v, int if kind is int else str):
+                    raise ValueError(f"{key!r} takes {'integer' if kind is int else 'string'} values, got {v!r}")
+
+def to_where(filter):
+    """{"file_type": "pdf", "page": {"$gte": 2, "$lte": 4}} -> Chroma where clause.
+
+    Chroma wants exactly one field or operator per object: several are split
+    into an $and, and an $and / $or of a single filter is unwrapped.
+    """
+    if not filter:
+        return None
+    parts = []
+    for key, cond in filter.items():
+        if key in ("$and", "$or"):
+            subs = [to_where(sub) for sub in cond]
+            parts.append(subs[0] if len(subs) == 1 else {key: subs})
+        elif isinstance(cond, dict) and len(cond) > 1:
+            parts.extend({key: {op: value}} for op, value in cond.items())
+        else:
+            parts.append({key: cond})
+    return parts[0] if len(parts) == 1 else {"$and": parts}
+
+def rrf_fuse(ranked_lists, k=60):
+    """Reciprocal-rank fusion of several ranked id lists, best first."""
+    scores = defaultdict(float)
+    for ranked in ranked_lists:
+        for rank, doc_id in enumerate(ranked):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda i: -scores[i])
+
+def hybrid_search(db, bm25, query, k=4, candidates=None, query_vector=None, filter=None):
+    """Vector + BM25 retrieval fused with RRF, returns Documents like similarity_search.
+
+    `filter` is a metadata filter ({"file_type": "pdf"}, {"page": {"$gte": 3}}, ...)
+    applied by both indexes before scoring.
+    """
+    candidates = candidates or k * 4
+    where = to_where(filter)
+    if query_vector is None:
+        vector_docs = db.similarity_search(query, k=candidates, filter=where)
+    else:
+        vector_docs = db.similarity_search_by_vector(query_vector, k=candidates, filter=where)
+    keyword_ids = [doc_id for doc_id, _ in bm25.search(query, k=candidates, filter=where)]
+    by_id = {doc.id: doc for doc in vector_docs}
+    fused = rrf_fuse([[doc.id for doc in vector_docs], keyword_ids])[:k]
+    missing = [i for i in fused if i not in by_id]
+    if missing:
+        by_id.update({doc.id: doc for doc in db.get_by_ids(missing)})
+    return [by_id[i] for i in fused if i in by_id]
+
+def _expansion_prompt(query, n):
+    return (
+        f"Write {n} different search queries for a document retrieval system that together "
+        f"cover the question below: rewrites with other wording, and sub-questions if it asks "
+        f"several things. Use the question's language. One query per line, nothing else.\n\n"
+        f"Question: {query}"
+    )
+
+def expand_query(chat_model, query, n=MULTI_QUERY_N):
+    """The query plus up to n rewrites / sub-questions written by the chat model in one call."""
+    if n <= 0:
+        return [query]
+    try:
+        text = chat_model.invoke(_expansion_prompt(query, n)).content
+    except Exception as e:
+        print(f"query expansion failed, searching the original query only: {e}")
+        return [query]
+    return _parse_expansions(query, text, n)
+
+async def aexpand_query(chat_model, query, n=MULTI_QUERY_N):
+    if n <= 0:
+        return [query]
+    try:
+        text = (await chat_model.ainvoke(_expansion_prompt(query, n))).content
+    except Exception as e:
+        print(f"query expansion failed, searching the original query only: {e}")
+        return [query]
+    return _parse_expansions(query, text, n)
+
+def _parse_expansions(query, text, n):
+    queries = [query]
+    for line in text.splitlines():
+        line = re.sub(r"^\s*(?:[-*]|\d+[.)、])\s*", "", line).strip()
+        if line and line not in queries:
+            queries.append(line)
+    return queries[:n + 1]
+
+def read_corpus_version(directory):
+    try:
+        with open(os.path.join(directory, CORPUS_VERSION_FILE), encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return "0"
+
+def bump_corpus_version(directory):
+    path = os.path.join(directory, CORPUS_VERSION_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp, path)
+
+class LRUCache:
+    """Thread-safe LRU cache with TTL; counts hits, misses and the compute time hits saved."""
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._data = OrderedDict()  # key -> (expires_at, cost_seconds, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (hit, value)."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[1]
+            return True, entry[2]
+
+    def put(self, key, value, cost_seconds=0.0):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, cost_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "saved_ms": round(self.saved_seconds * 1000, 1),
+        }
+
+class CachedRetriever:
+    """hybrid_search behind a query -> embedding and a (query, k, filter) -> results cache.
+
+    The result cache is dropped as soon as the corpus version in `directory` changes,
+    i.e. after any ingest through CustomVectorDB, and the BM25 index is reloaded.
+    Query embeddings do not depend on the corpus and are kept.
+    """
+
+    def __init__(self, db, directory, embeddings, maxsize=1024, ttl=3600):
+        self.db = db
+        self.directory = directory
+        self.embeddings = embeddings
+        self.embedding_cache = LRUCache(maxsize, ttl)
+        self.result_cache = LRUCache(maxsize, ttl)
+        self.version = read_corpus_version(directory)
+        self.bm25 = load_bm25_index(db, directory)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(MULTI_QUERY_N + 1, 2), thread_name_prefix="retrieve")
+
+    def _check_version(self):
+        version = read_corpus_version(self.directory)
+        if version == self.version:
+            return
+        with self._lock:
+            if version == self.version:
+                return
+            print(f"corpus version changed ({self.version} -> {version}), dropping cached results")
+            self.result_cache.clear()
+            if hasattr(self.db, "_reset_cache"):
+                self.db._reset_cache()  # flat backend keeps its files memory-mapped
+            self.bm25 = load_bm25_index(self.db, self.directory)
+            self.version = version
+
+    def embed_query(self, query):
+        hit, vector = self.embedding_cache.get(query)
+        if not hit:
+            start = time.perf_counter()
+            vector = self.embeddings.embed_query(query)
+            self.embedding_cache.put(query, vector, time.perf_counter() - start)
+        return vector
+
+    async def aembed_query(self, query):
+        hit, vector = self.embedding_cache.get(query)
+        if not hit:
+            start = time.perf_counter()
+            vector = await self.embeddings.aembed_query(query)
+            self.embedding_cache.put(query, vector, time.perf_counter() - start)
+        return vector
+
+    def embed_queries(self, queries):
+        """Embeddings of several queries, the uncached ones in a single batched request."""
+        vectors = {}
+        for query in queries:
+            hit, vector = self.embedding_cache.get(query)
+            if hit:
+                vectors[query] = vector
+        missing = [q for q in dict.fromkeys(queries) if q not in vectors]
+        if missing:
+            start = time.perf_counter()
+            embedded = self.embeddings.embed_documents(missing)
+            cost = (time.perf_counter() - start) / len(missing)
+            for query, vector in zip(missing, embedded):
+                self.embedding_cache.put(query, vector, cost)
+                vectors[query] = vector
+        return [vectors[q] for q in queries]
+
+    async def aembed_queries(self, queries):
+        vectors = {}
+        for query in queries:
+            hit, vector = self.embedding_cache.get(query)
+            if hit:
+                vectors[query] = vector
+        missing = [q for q in dict.fromkeys(queries) if q not in vectors]
+        if missing:
+            start = time.perf_counter()
+            embedded = await self.embeddings.aembed_documents(missing)
+            cost = (time.perf_counter() - start) / len(missing)
+            for query, vector in zip(missing, embedded):
+                self.embedding_cache.put(query, vector, cost)
+                vectors[query] = vector
+        return [vectors[q] for q in queries]
+
+    def _result_key(self, query, k, filter):
+        return (query, k, json.dumps(filter, sort_keys=True, ensure_ascii=False) if filter else None)
+
+    def _search_uncached(self, key, query, k, filter, query_vector):
+        start = time.perf_counter()
+        docs = hybrid_search(self.db, self.bm25, query, k=k, query_vector=query_vector, filter=filter)
+        self.result_cache.put(key, docs, time.perf_counter() - start)
+        return docs
+
+    def search(self, query, k=4, filter=None, query_vector=None):
+        self._check_version()
+        key = self._result_key(query, k, filter)
+        hit, docs = self.result_cache.get(key)
+        if hit:
+            return docs
+        if query_vector is None:
+            query_vector = self.embed_query(query)
+        return self._search_uncached(key, query, k, filter, query_vector)
+
+    def multi_search(self, queries, k=4, filter=None):
+        """Search every query variant concurrently and fuse the rankings with RRF."""
+        if len(queries) == 1:
+            return self.search(queries[0], k=k, filter=filter)
+        vectors = self.embed_queries(queries)
+        results = list(self._pool.map(
+            lambda qv: self.search(qv[0], k=k, filter=filter, query_vector=qv[1]), zip(queries, vectors)
+        ))
+        by_id = {doc.id: doc for docs in results for doc in docs}
+        fused = rrf_fuse([[doc.id for doc in docs] for docs in results])[:k]
+        return [by_id[i] for i in fused]
+
+    async def asearch(self, query, k=4, filter=None, query_vector=None):
+        """search() for asyncio servers: async embedding, the index lookup runs in a worker thread."""
+        loop = asyncio.get_running_loop()
+        # reads the version file and, after an ingest, reloads (or rebuilds) the BM25 index
+        await loop.run_in_executor(None, self._check_version)
+        key = self._result_key(query, k, filter)
+        hit, docs = self.result_cache.get(key)
+        if hit:
+            return docs
+        if query_vector is None:
+            query_vector = await self.aembed_query(query)
+        return await loop.run_in_executor(None, self._search_uncached, key, query, k, filter, query_vector)
+
+    async def amulti_search(self, queries, k=4, filter=None):
+        if len(queries) == 1:
+            return await self.asearch(queries[0], k=k, filter=filter)
+        vectors = await self.aembed_queries(queries)
+        results = await asyncio.gather(*(
+            self.asearch(q, k=k, filter=filter, query_vector=v) for q, v in zip(queries, vectors)
+        ))
+        by_id = {doc.id: doc for docs in results for doc in docs}
+        fused = rrf_fuse([[doc.id for doc in docs] for docs in results])[:k]
+        return [by_id[i] for i in fused]
+
+    def stats(self):
+        return {"embedding": self.embedding_cache.stats(), "results": self.result_cache.stats()}
@@ -0,0 +1,55 @@
+import os
+from functools import lru_cache
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# recursive: docling's default chunks re-split by characters
+# structure: docling chunks packed to a token budget, tables / lists / sections kept whole when they fit
+SPLITTER = os.getenv("SPLITTER", "recursive")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", 512))
+# count tokens like the embedding model does (characters are a poor proxy for Chinese text)
+SPLITTER_TOKENIZER = os.getenv("SPLITTER_TOKENIZER", "Qwen/Qwen3-Embedding-0.6B")
+
+def splitter_config():
+    """Settings that change the chunks; a different config means every file is re-split."""
+    if SPLITTER == "structure":
+        return {"splitter": SPLITTER, "max_tokens": CHUNK_MAX_TOKENS, "tokenizer": SPLITTER_TOKENIZER}
+    return {"splitter": SPLITTER}
+
+@lru_cache(maxsize=None)
+def get_chunker():
+    """HybridChunker handed to DoclingLoader, or None for docling's default chunker."""
+    if SPLITTER != "structure":
+        return None
+    from docling.chunking import HybridChunker
+    from docling_core.transforms.chunker.tokenizer.huggingface import HuggingFaceTokenizer
+    from transformers import AutoTokenizer
+    tokenizer = HuggingFaceTokenizer(
+        tokenizer=AutoTokenizer.from_pretrained(SPLITTER_TOKENIZER),
+        max_tokens=CHUNK_MAX_TOKENS,
+    )
+    # walks the document tree: items are never cut unless one alone exceeds the budget,
+    # undersized neighbours under the same headings are merged up to the budget
+    return HybridChunker(tokenizer=tokenizer, merge_peers=True)
+
+class StructureSplitter:
+    """Keeps the token-budgeted docling chunks as they are and only adds start_index.
+
+    start_index is the chunk's offset in the file's chunk sequence, so ids stay
+    positional (like the character splitter's) and neighbours can be found.
+    """
+
+    def split_documents(self, docs):
+        offset = 0
+        for doc in docs:
+            doc.metadata["start_index"] = offset
+            offset += len(doc.page_content)
+        return docs
+
+def get_text_splitter():
+    if SPLITTER == "structure":
+        return StructureSplitter()
+    return RecursiveCharacterTextSplitter(
+        chunk_size=2000,  # 增大chunk size到8000字符
+        chunk_overlap=100,  # 相应增大overlap
+        add_start_index=True,  # track index in original document
+    )
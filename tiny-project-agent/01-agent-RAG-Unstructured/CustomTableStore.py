@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+import numpy as np
+
+TABLE_DIR = "tables"
+TABLE_CATALOG_FILE = "tables.json"
+# a column is numeric when at least this share of its non-empty cells parse as numbers
+NUMERIC_MIN_RATIO = 0.8
+AGGREGATIONS = ("sum", "mean", "min", "max", "count", "nunique")
+_NUMBER_NOISE_RE = re.compile(r"[,\s$¥€£%]|元|￥")
+
+def _to_number(cell):
+    text = _NUMBER_NOISE_RE.sub("", str(cell))
+    if text.startswith("(") and text.endswith(")"):
+        text = "-" + text[1:-1]  # accounting negatives
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def to_columns(header, rows):
+    """Column name -> numpy array: float64 (NaN for blanks) if mostly numeric, else str."""
+    columns = {}
+    for i, name in enumerate(header):
+        name = str(name).strip() or f"col{i}"
+        while name in columns:
+            name += "_"
+        cells = [str(row[i]).strip() if i < len(row) and row[i] is not None else "" for row in rows]
+        cells = ["" if c.lower() == "nan" else c for c in cells]
+        numbers = [_to_number(c) if c else None for c in cells]
+        n_filled = sum(1 for c in cells if c)
+        if n_filled and sum(n is not None for n in numbers) >= NUMERIC_MIN_RATIO * n_filled:
+            columns[name] = np.array([np.nan if n is None else n for n in numbers], dtype=np.float64)
+        else:
+            columns[name] = np.array(cells, dtype=str)
+    return columns
+
+def extract_tables(document):
+    """[(metadata, columns)] for every table of a DoclingDocument (XLSX sheets, DOCX/PPTX/PDF tables)."""
+    tables = []
+    for item in document.tables:
+        df = item.export_to_dataframe(doc=document)
+        if df.empty:
+            continue
+        pages = [prov.page_no for prov in item.prov]
+        metadata = {
+            "page": min(pages) if pages else -1,
+            "caption": item.caption_text(document) or "",
+        }
+        tables.append((metadata, to_columns(list(df.columns), df.values.tolist())))
+    return tables
+
+def _cast(col, key, value):
+    """A filter value in the column's type; a bound that is not a number fails instead of comparing as None."""
+    if col.dtype.kind != "f":
+        return str(value)
+    try:
+        number = _to_number(value) if isinstance(value, str) else float(value)
+    except (TypeError, ValueError):
+        number = None
+    if number is None:
+        raise ValueError(f"column {key!r} is numeric, {value!r} is not a number")
+    return number
+
+def _mask(columns, where, n_rows):
+    """Vectorized match_where: boolean row mask for a Chroma-style filter on the columns."""
+    mask = np.ones(n_rows, dtype=bool)
+    for key, cond in (where or {}).items():
+        if key == "$and":
+            for sub in cond:
+                mask &= _mask(columns, sub, n_rows)
+            continue
+        if key == "$or":
+            mask &= np.logical_or.reduce([_mask(columns, sub, n_rows) for sub in cond])
+            continue
+        if key not in columns:
+            raise ValueError(f"unknown column {key!r}, columns are {list(columns)}")
+        col = columns[key]
+        ops = cond if isinstance(cond, dict) else {"$eq": cond}
+        for op, value in ops.items():
+            if op in ("$in", "$nin"):
+                hit = np.isin(col, [_cast(col, key, v) for v in value])
+                mask &= hit if op == "$in" else ~hit
+            elif op == "$contains":
+                mask &= np.char.find(np.char.lower(col.astype(str)), str(value).lower()) >= 0
+            elif op in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+                if op not in ("$eq", "$ne") and col.dtype.kind != "f":
+                    raise ValueError(f"{op} needs a numeric column, {key!r} is text")
+                value = _cast(col, key, value)
+                compare = {"$eq": np.equal, "$ne": np.not_equal, "$gt": np.greater, "$gte": np.greater_equal,
+                           "$lt": np.less, "$lte": np.less_equal}[op]
+                mask &= compare(col, value)
+            else:
+                raise ValueError(f"unsupported operator {op}")
+    return mask
+
+def _aggregate(values, op, groups, n_groups):
+    """One aggregate per group (groups[i] is row i's group number), without a Python loop over rows."""
+    if op == "count":
+        return np.bincount(groups, minlength=n_groups).tolist()
+    numeric = values.dtype.kind == "f"
+    if numeric:
+        valid = ~np.isnan(values)
+        values, groups = values[valid], groups[valid]
+    if op == "nunique":
+        codes = np.unique(values, return_inverse=True)[1].reshape(-1)
+        pairs = np.unique(np.column_stack([groups, codes]), axis=0) if values.size else np.empty((0, 2), int)
+        return np.bincount(pairs[:, 0].astype(int), minlength=n_groups).tolist()
+    if not numeric:
+        raise ValueError(f"{op} needs a numeric column")
+    counts = np.bincount(groups, minlength=n_groups)
+    if op in ("sum", "mean"):
+        result = np.bincount(groups, weights=values, minlength=n_groups)
+        if op == "mean":
+            result = result / np.maximum(counts, 1)
+    else:
+        result = np.full(n_groups, np.inf if op == "min" else -np.inf)
+        (np.minimum if op == "min" else np.maximum).at(result, groups, values)
+    return [float(v) if c else None for v, c in zip(result, counts)]
+
+class TableStore:
+    """Columnar store of the tables found in ingested documents, next to the collection.
+
+    Every table is one .npz of numpy columns under `tables/`; tables.json is the
+    catalog (source, page, caption, column names and types, row count, file).
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, TABLE_DIR)
+        self.catalog_path = os.path.join(self.directory, TABLE_CATALOG_FILE)
+        self._catalog = None
+        self._catalog_mtime = None
+        self._columns = {}
+        self._lock = threading.Lock()
+
+    def catalog(self):
+        """table id -> info, re-read when an ingest rewrote it."""
+        with self._lock:
+            mtime = os.path.getmtime(self.catalog_path) if os.path.isfile(self.catalog_path) else None
+            if self._catalog is None or mtime != self._catalog_mtime:
+                self._catalog = {}
+                if mtime is not None:
+                    with open(self.catalog_path, encoding="utf-8") as f:
+                        self._catalog = json.load(f)
+                self._catalog_mtime = mtime
+                self._columns.clear()
+            return self._catalog
+
+    def _save_catalog(self, catalog):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.catalog_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(catalog, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.catalog_path)
+
+    def _table_id(self, source, index, catalog):
+        table_id = f"{re.sub(r'[^0-9A-Za-z]+', '_', os.path.splitext(os.path.basename(source))[0])}_{index}"
+        if catalog.get(table_id, {}).get("source", source) != source:
+            table_id += "_" + hashlib.sha1(source.encode("utf-8")).hexdigest()[:6]
+        return table_id
+
+    def replace_source(self, source, tables):
+        """Swap all tables of one source file for the newly extracted ones.
+
+        The new tables go to new files and the catalog is switched to them
+        before the old files are deleted, so a crash leaves a usable catalog.
+        """
+        old_files = {self._file(k, v) for k, v in self.catalog().items() if v["source"] == source}
+        catalog = {k: v for k, v in self.catalog().items() if v["source"] != source}
+        os.makedirs(self.directory, exist_ok=True)
+        for index, (metadata, columns) in enumerate(tables):
+            table_id = self._table_id(source, index, catalog)
+            file = f"{table_id}.{uuid.uuid4().hex[:8]}.npz"
+            np.savez(os.path.join(self.directory, file),
+                     **{f"c{i}": col for i, col in enumerate(columns.values())})
+            catalog[table_id] = {
+                "source": source,
+                **metadata,
+                "columns": {name: "number" if col.dtype.kind == "f" else "text" for name, col in columns.items()},
+                "rows": int(len(next(iter(columns.values())))) if columns else 0,
+                "file": file,
+            }
+        self._save_catalog(catalog)
+        self._remove_files(old_files)
+
+    def remove_source(self, source):
+        catalog = self.catalog()
+        old_files = {self._file(k, v) for k, v in catalog.items() if v["source"] == source}
+        if old_files:
+            self._save_catalog({k: v for k, v in catalog.items() if v["source"] != source})
+            self._remove_files(old_files)
+
+    @staticmethod
+    def _file(table_id, info):
+        return info.get("file", table_id + ".npz")  # catalogs written before "file" existed
+
+    def _remove_files(self, files):
+        for file in files:
+            try:
+                os.remove(os.path.join(self.directory, file))
+            except FileNotFoundError:
+                pass
+
+    def columns(self, table_id):
+        catalog = self.catalog()
+        if table_id not in catalog:
+            raise ValueError(f"unknown table {table_id!r}, tables are {list(catalog)}")
+        with self._lock:
+            if table_id not in self._columns:
+                with np.load(os.path.join(self.directory, self._file(table_id, catalog[table_id]))) as data:
+                    self._columns[table_id] = {
+                        name: data[f"c{i}"] for i, name in enumerate(catalog[table_id]["columns"])
+                    }
+            return self._columns[table_id]
+
+    def query(self, table_id, where=None, group_by=None, aggregate=None, columns=None, limit=20):
+        """Filter rows and optionally aggregate them, all as numpy array operations.
+
+        aggregate maps column -> one of AGGREGATIONS ({"销售额": "sum"}); with
+        group_by the aggregates are computed per distinct value of that column.
+        Without aggregate the matching rows are returned (at most `limit`).
+        Returns {"columns": [...], "rows": [[...]], "matched": n}.
+        """
+        data = self.columns(table_id)
+        n_rows = self.catalog()[table_id]["rows"]
+        mask = _mask(data, where, n_rows)
+        matched = int(mask.sum())
+        if not aggregate:
+            names = columns or list(data)
+            unknown = [name for name in names if name not in data]
+            if unknown:
+                raise ValueError(f"unknown columns {unknown}, columns are {list(data)}")
+            rows = np.column_stack([data[name][mask][:limit].astype(object) for name in names]).tolist() if names else []
+            return {"columns": names, "rows": rows, "matched": matched}
+        for name, op in aggregate.items():
+            if op not in AGGREGATIONS:
+                raise ValueError(f"unsupported aggregation {op}, use one of {AGGREGATIONS}")
+            if name not in data:
+                raise ValueError(f"unknown column {name!r}, columns are {list(data)}")
+        names = [f"{op}({name})" for name, op in aggregate.items()]
+        if group_by is None:
+            groups = np.zeros(matched, dtype=int)
+            row = [_aggregate(data[name][mask], op, groups, 1)[0] for name, op in aggregate.items()]
+            return {"columns": names, "rows": [row], "matched": matched}
+        if group_by not in data:
+            raise ValueError(f"unknown column {group_by!r}, columns are {list(data)}")
+        keys, groups = np.unique(data[group_by][mask], return_inverse=True)
+        groups = groups.reshape(-1)
+        results = [_aggregate(data[name][mask], op, groups, len(keys)) for name, op in aggregate.items()]
+        rows = [[key.item()] + [r[g] for r in results] for g, key in enumerate(keys)][:limit]
+        return {"columns": [group_by] + names, "rows": rows, "matched": matched}
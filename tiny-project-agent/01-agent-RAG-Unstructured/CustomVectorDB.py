@@ -1,14 +1,50 @@
 from LLM import embed_llm
-from CustomConverter import converter
+from CustomConverter import converter, file_hash
 from langchain_chroma import Chroma
 from langchain_docling import DoclingLoader
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from CustomPipeline import Pipeline, print_report
+from CustomRetriever import BM25Index, bump_corpus_version
+from CustomFlatIndex import FlatVectorStore
+from CustomDedup import DedupIndex
+from CustomSplitter import get_chunker, get_text_splitter, splitter_config
+from CustomParentStore import ParentStore
+from CustomTableStore import TableStore, extract_tables
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+import argparse
+import hashlib
+import json
 import os
+import time
+
+MANIFEST_FILE = "manifest.json"
+# 入库时维护的统计表，读取统计不再需要扫描整个collection
+STATS_FILE = "collection_stats.json"
+# chroma: SQLite + HNSW；flat: numpy 精确检索（mmap .npy），适合百万chunk以内的小语料
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+FLAT_INDEX_DTYPE = os.getenv("FLAT_INDEX_DTYPE", "float32")
+# flat后端的量化检索: none / int8 / binary（先用量化码筛候选，再用原始向量精排）
+FLAT_QUANTIZATION = os.getenv("FLAT_QUANTIZATION", "none")
+JOURNAL_FILE = "ingest_journal.jsonl"
+# 每写入这么多个chunk记录一次journal
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 256))
+# 并行转换的进程数，设为1则在当前进程内顺序转换
+# 每个进程都加载一整套docling模型（layout/VLM pipeline），并同时向VLM服务发 VL_CONCURRENCY 个请求：
+# 内存约为 进程数 x 一套模型，VLM并发约为 进程数 x VL_CONCURRENCY，按内存和VLM服务的并发槽位往上调
+CONVERT_WORKERS = int(os.getenv("CONVERT_WORKERS", 2))
+# 流水线各阶段之间最多排队的文件数
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 4))
+# chunk: 直接embedding切分好的chunk；parent: 只embedding更小的子chunk，父chunk原文存到parents.sqlite
+INDEX_MODE = os.getenv("INDEX_MODE", "chunk")
+CHILD_CHUNK_SIZE = int(os.getenv("CHILD_CHUNK_SIZE", 400))
 
 def get_raw_docs_paths(dpath='./docs'):
     return [os.path.join(dpath, i) for i in os.listdir(dpath)]
 
-def init_vector_database(directory, embed_llm):
+def init_vector_database(directory, embed_llm, backend=VECTOR_BACKEND):
+    if backend == "flat":
+        return FlatVectorStore(directory, embed_llm, collection_name="db1",
+                               dtype=FLAT_INDEX_DTYPE, quantization=FLAT_QUANTIZATION)
     vector_store = Chroma(
         collection_name="db1",
         embedding_function=embed_llm,
@@ -16,65 +52,554 @@ def init_vector_database(directory, embed_llm):
     )
     return vector_store
 
-def load_raw_docs_and_split(docs_path, converter):
-    loader = DoclingLoader(docs_path, converter=converter)
-    docs = loader.load()
-    print(f"Loaded {len(docs)} documents.")
+class _DocumentRecorder:
+    """Converter look-alike that keeps the DoclingDocument of the conversion DoclingLoader runs."""
 
-    # define spliter and split document(s)
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=2000,  # 增大chunk size到8000字符
-        chunk_overlap=100,  # 相应增大overlap
-        add_start_index=True,  # track index in original document
-    )
-    all_splits = text_splitter.split_documents(docs)
+    def __init__(self, converter):
+        self.converter = converter
+        self.document = None
+
+    def convert(self, source, **kwargs):
+        res = self.converter.convert(source, **kwargs)
+        self.document = res.document
+        return res
+
+def load_file(path, converter):
+    """(chunks, tables) of one file from a single conversion.
+
+    tables is None if table extraction failed, so the file keeps its old tables.
+    """
+    recorder = _DocumentRecorder(converter)
+    docs = DoclingLoader(path, converter=recorder, chunker=get_chunker()).load()
+    try:
+        tables = extract_tables(recorder.document)
+    except Exception as e:
+        print(f"table extraction failed: {path}: {e}")
+        tables = None
+    return docs, tables
+
+# 每个worker进程持有一个预热好的converter，避免每个文件重复初始化pipeline
+_worker_converter = None
+
+def _init_convert_worker():
+    global _worker_converter
+    from CustomConverter import converter
+    for fmt in converter.allowed_formats:
+        converter.initialize_pipeline(fmt)
+    _worker_converter = converter
+
+def _convert_one(path):
+    return (path, *load_file(path, _worker_converter))
+
+def iter_converted_docs(docs_path, converter, max_workers=CONVERT_WORKERS):
+    """Yield (path, docs, tables) for each file as soon as its conversion finishes.
+
+    With max_workers > 1 files are fanned out over a process pool, each worker
+    using its own warmed copy of CustomConverter.converter. At most
+    workers + INGEST_QUEUE_SIZE files are submitted at a time, so converted
+    documents never pile up while a later stage is slow.
+    """
+    docs_path = list(docs_path)
+    if max_workers <= 1 or len(docs_path) <= 1:
+        for path in docs_path:
+            try:
+                docs, tables = load_file(path, converter)
+            except Exception as e:
+                print(f"convert failed: {path}: {e}")
+                continue
+            yield path, docs, tables
+        return
+    workers = min(max_workers, len(docs_path))
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_convert_worker)
+    todo = iter(docs_path)
+    pending = {}
+    try:
+        for path in todo:
+            pending[pool.submit(_convert_one, path)] = path
+            if len(pending) >= workers + INGEST_QUEUE_SIZE:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                # refill the window before handing the result on, workers stay busy
+                following = next(todo, None)
+                if following is not None:
+                    pending[pool.submit(_convert_one, following)] = following
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"convert failed: {path}: {e}")
+                    continue
+                yield result
+    finally:
+        # a failed later stage closes this generator: drop queued files instead of converting them
+        workers_alive = list((pool._processes or {}).values())  # shutdown() forgets them
+        pool.shutdown(wait=False, cancel_futures=True)
+        if pending:
+            # files already handed to a worker (running or prefetched) would still convert, possibly
+            # minutes of VLM calls whose result nobody reads: stop the workers instead
+            for process in workers_alive:
+                process.terminate()
+
+def iter_split_docs(docs_path, converter, max_workers=CONVERT_WORKERS):
+    """Yield (path, split_docs) per file, splitting while other files still convert."""
+    text_splitter = get_text_splitter()
+    for path, docs, _ in iter_converted_docs(docs_path, converter, max_workers):
+        yield path, text_splitter.split_documents(docs)
+
+def load_raw_docs_and_split(docs_path, converter, max_workers=CONVERT_WORKERS):
+    n_docs, all_splits = 0, []
+    for _, splits in iter_split_docs(docs_path, converter, max_workers):
+        n_docs += 1
+        all_splits.extend(splits)
+    print(f"Loaded {n_docs} documents.")
     print(f"Split documents into {len(all_splits)} sub-documents.")
     return all_splits
 
+def compact_metadata(metadata, source, ingest_time):
+    """Flatten docling's dl_meta into a few scalar, filterable fields (Chroma only stores scalars)."""
+    dl_meta = metadata.get('dl_meta') or {}
+    pages = [prov.get('page_no') for item in dl_meta.get('doc_items', []) for prov in item.get('prov', [])]
+    pages = [p for p in pages if p is not None]
+    source = metadata.get('source', source)
+    return {
+        'source': source,
+        'start_index': metadata.get('start_index', -1),
+        'file_type': os.path.splitext(source)[1].lstrip('.').lower() or 'unknown',
+        'page': min(pages) if pages else -1,
+        'headings': " > ".join(dl_meta.get('headings') or []),
+        'ingest_time': ingest_time,
+    }
+
+# manifest: 记录每个源文件及其chunk的内容hash，用于增量更新
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def load_manifest(name):
+    path = os.path.join(name, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return {"files": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(name, manifest):
+    # 先写临时文件再替换，避免中途退出留下损坏的manifest
+    path = os.path.join(name, MANIFEST_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+# collection stats: 由manifest汇总，每次入库结束时重写
+def write_collection_stats(name, manifest, embedding_dim=None):
+    files = manifest["files"]
+    old = read_collection_stats(name) or {}
+    sources, file_types = {}, {}
+    for source, entry in files.items():
+        file_type = entry.get("file_type") or os.path.splitext(source)[1].lstrip('.').lower() or 'unknown'
+        chunks = entry.get("chunks", [])
+        kept = sum(1 for c in chunks if "dup_of" not in c)
+        sources[source] = {"chunks": kept, "duplicates": len(chunks) - kept,
+                           "chars": entry.get("chars", 0), "file_type": file_type}
+        file_types[file_type] = file_types.get(file_type, 0) + sources[source]["chunks"]
+    stats = {
+        "total_sources": len(sources),
+        "total_chunks": sum(s["chunks"] for s in sources.values()),
+        "total_duplicates": sum(s["duplicates"] for s in sources.values()),
+        "total_chars": sum(s["chars"] for s in sources.values()),
+        "embedding_dim": embedding_dim or old.get("embedding_dim"),
+        "file_types": file_types,
+        "sources": sources,
+        "updated": int(time.time()),
+    }
+    path = os.path.join(name, STATS_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+    return stats
+
+def read_collection_stats(name):
+    """Stats written by the last ingest, or None if the database predates them."""
+    path = os.path.join(name, STATS_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def iter_collection(db, page_size=500, include=("metadatas",)):
+    """Yield (id, metadata[, document]) page by page instead of loading the whole collection."""
+    offset = 0
+    while True:
+        page = db._collection.get(limit=page_size, offset=offset, include=list(include))
+        ids = page["ids"]
+        if not ids:
+            return
+        columns = [page[field] for field in include]
+        for row in zip(ids, *columns):
+            yield row
+        offset += len(ids)
+
+class IngestJournal:
+    """Append-only write-ahead log of one ingest run, fsync'ed after every record.
+
+    Records: {"op": "batch", source, hash, ids} after a chunk batch is upserted,
+    {"op": "file", source, entry} after a file is complete, {"op": "removed", source}.
+    The journal is deleted once the manifest is saved, so an existing journal
+    means the last run did not finish.
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(name, JOURNAL_FILE)
+        self._f = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def open(self, resume=False):
+        self._f = open(self.path, "a" if resume else "w", encoding="utf-8")
+
+    def log(self, **record):
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def replay(self, files, hashes):
+        """Apply finished work of the crashed run to the manifest `files`.
+
+        Returns {source: set(ids)} of batches already upserted for files that did
+        not finish, so they are not embedded again.
+        """
+        partial = {}
+        if not self.exists():
+            return partial
+        n_files = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn last line: that write never completed
+                source = record.get("source")
+                if record["op"] == "removed":
+                    files.pop(source, None)
+                elif hashes.get(source) != record.get("hash"):
+                    continue  # file changed again since the crash
+                elif record["op"] == "batch":
+                    partial.setdefault(source, set()).update(record["ids"])
+                elif record["op"] == "file":
+                    files[source] = record["entry"]
+                    partial.pop(source, None)
+                    n_files += 1
+        print(f"resume: {n_files} files already done, {len(partial)} files partially done")
+        return partial
+
+    def commit(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if self.exists():
+            os.remove(self.path)
+
+# 稳定的chunk id: 同一文件同一位置同样内容的chunk永远得到同一个id，重复导入即覆盖
+def index_config():
+    """Splitter settings plus the index mode, stored in the manifest."""
+    config = splitter_config()
+    if INDEX_MODE == "parent":
+        config.update(index_mode=INDEX_MODE, child_chunk_size=CHILD_CHUNK_SIZE)
+    return config
+
+def split_children(parents, parent_ids):
+    """Cut each parent into small child chunks that point back at it (INDEX_MODE=parent)."""
+    child_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHILD_CHUNK_SIZE, chunk_overlap=CHILD_CHUNK_SIZE // 8, add_start_index=True,
+    )
+    children = []
+    for parent, parent_id in zip(parents, parent_ids):
+        start = parent.metadata["start_index"]
+        for child in child_splitter.split_documents([parent]):
+            offset = child.metadata["start_index"]
+            child.metadata = {**parent.metadata, "start_index": start + offset if start >= 0 else offset,
+                              "parent_id": parent_id}
+            children.append(child)
+    return children
+
+def kept_ids(entry):
+    """Ids of a manifest entry's chunks that are stored (not dropped as near-duplicates)."""
+    return {c["id"] for c in entry.get("chunks", []) if "dup_of" not in c}
+
+def chunk_id(doc, occurrence=0):
+    parts = [
+        str(doc.metadata.get('source', 'unknown')),
+        str(doc.metadata.get('start_index', -1)),
+        chunk_hash(doc.page_content),
+    ]
+    if occurrence:
+        parts.append(str(occurrence))
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()[:32]
+
+def assign_chunk_ids(docs):
+    """Set doc.id for one file's chunks and return the ids.
+
+    start_index is an offset inside a docling chunk, not the file, so identical
+    texts (repeated footers, table blocks) can share source/start_index/hash;
+    the n-th repeat gets its ordinal in the key. Unique chunks keep the plain id.
+    """
+    seen = {}
+    for doc in docs:
+        base = chunk_id(doc)
+        doc.id = chunk_id(doc, seen.get(base, 0))
+        seen[base] = seen.get(base, 0) + 1
+    return [doc.id for doc in docs]
+
+def upsert_documents(db, docs, embeddings=None):
+    """Insert or overwrite chunks under their deterministic ids, return the ids.
+
+    Pass precomputed `embeddings` to skip the embedding call inside the store.
+    """
+    if not docs:
+        return []
+    # Chroma rejects a batch with repeated ids, keep the first of each
+    unique = {}
+    for i, doc in enumerate(docs):
+        unique.setdefault(doc.id or chunk_id(doc), i)
+    if len(unique) < len(docs):
+        docs = [docs[i] for i in unique.values()]
+        if embeddings is not None:
+            embeddings = [embeddings[i] for i in unique.values()]
+    ids = list(unique)
+    if embeddings is None:
+        # Chroma.add_documents 在给定ids时走 collection.upsert
+        db.add_documents(docs, ids=ids)
+    else:
+        db._collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            documents=[doc.page_content for doc in docs],
+            metadatas=[doc.metadata for doc in docs],
+        )
+    return ids
+
+def delete_by_source(db, source):
+    """Delete every chunk that came from the given source file."""
+    db.delete(where={"source": source})
+
+def update_vector_database(docs_path, name="chroma_db", prune=True, resume=False):
+    """Incrementally sync the given files into the database.
+
+    Only new or changed files (by content hash) are converted and embedded;
+    inside a changed file, chunks whose id is unchanged keep their vectors.
+    With prune=True, chunks of files that are no longer in docs_path are deleted.
+    With resume=True, work journaled by an interrupted run is not redone.
+    """
+    manifest = load_manifest(name)
+    files = manifest["files"]
+    hashes = {p: file_hash(p) for p in docs_path}
+    journal = IngestJournal(name)
+    # 有目录却没有manifest也没有journal：旧版本建的库（首次导入中断时会留下journal）
+    legacy = os.path.isdir(name) and not os.path.isfile(os.path.join(name, MANIFEST_FILE)) and not journal.exists()
+    partial = {}
+    if resume:
+        partial = journal.replay(files, hashes)
+    elif journal.exists():
+        print(f"found unfinished ingest in {name}, starting over (use --resume to continue it)")
+    changed = [p for p, h in hashes.items() if files.get(p, {}).get("hash") != h]
+    if files and manifest.get("splitter", {"splitter": "recursive"}) != index_config():
+        print("splitter config changed, re-splitting every file")
+        changed = list(hashes)
+    manifest["splitter"] = index_config()
+    removed = [s for s in files if s not in hashes] if prune else []
+    # 去重时丢弃的chunk指向别的文件里保留的那份，那份变了/删了就要重新处理这些文件
+    owned = set().union(*(kept_ids(files[s]) for s in changed + removed if s in files))
+    changed += [
+        s for s in hashes if s not in changed
+        and any(c.get("dup_of") in owned for c in files.get(s, {}).get("chunks", []))
+    ]
+    if not changed and not removed:
+        if journal.exists():
+            save_manifest(name, manifest)
+            journal.commit()
+        if read_collection_stats(name) is None and os.path.isdir(name):
+            write_collection_stats(name, manifest)
+        print(f"{name} database is up to date.")
+        return []
+    print(f"{len(changed)} new/changed files, {len(removed)} removed files.")
+    embedding_dim = None
+
+    db = init_vector_database(name, embed_llm)
+    print(f"数据库容量加载前容量：{db._collection.count()}")
+    # 关键词索引与向量库同步更新
+    bm25 = BM25Index.load(name)
+    dedup = DedupIndex.load(name)
+    parents = ParentStore(name)
+    tables = TableStore(name)
+    for source in changed + removed:
+        dedup.remove_source(source)
+    if legacy and db._collection.count():
+        # 旧版本建的库没有manifest，chunk是随机id：先删掉，否则会和确定性id的新chunk并存
+        legacy_sources = {metadata.get("source") for _, metadata in iter_collection(db)}
+        legacy_sources = [s for s in legacy_sources if prune or s in hashes]
+        print(f"{name} has no manifest, deleting {len(legacy_sources)} sources written by the old ingest")
+        for source in legacy_sources:
+            delete_by_source(db, source)
+            bm25.remove_source(source)
+    # 写入前后都更新版本号，中途失败也不会让检索缓存返回旧结果
+    bump_corpus_version(name)
+    journal.open(resume=resume)
+
+    def save_indexes():
+        # 关键词索引和去重索引随journal一起落盘，先于file/removed记录：
+        # 续传时replay跳过的文件，它们在两个索引里的改动一定已经保存
+        dedup.save()
+        bm25.save()
+
+    for source in removed:
+        delete_by_source(db, source)
+        bm25.remove_source(source)
+        if INDEX_MODE == "parent":
+            parents.remove_source(source)
+        tables.remove_source(source)
+        files.pop(source)
+    save_indexes()
+    for source in removed:
+        journal.log(op="removed", source=source)
+
+    # 流水线: convert -> split -> embed -> upsert, 各阶段并行，阶段之间是有界队列
+    # 失败的文件保留旧chunk，下次重试
+    text_splitter = get_text_splitter()
+    ingest_time = int(time.time())
+
+    def split(item):
+        source, docs, file_tables = item
+        docs = text_splitter.split_documents(docs)
+        for doc in docs:
+            # 复杂的dl_meta压缩成几个可过滤的标量字段
+            doc.metadata = compact_metadata(doc.metadata, source, ingest_time)
+        chars = sum(len(doc.page_content) for doc in docs)
+        parent_docs, parent_ids = [], []
+        if INDEX_MODE == "parent":
+            # 父chunk不进向量库，向量库里只有指向它的子chunk
+            parent_docs, parent_ids = docs, assign_chunk_ids(docs)
+            docs = split_children(parent_docs, parent_ids)
+        old_ids = kept_ids(files.get(source, {}))
+        old_ids |= partial.get(source, set())  # batches upserted before an interruption
+        chunks = [{"id": i, "hash": chunk_hash(doc.page_content)} for i, doc in zip(assign_chunk_ids(docs), docs)]
+        # 近似重复的chunk（页眉页脚、重复表头…）不embedding也不入库，只在manifest里记录指向
+        docs, dup_of = dedup.dedup([c["id"] for c in chunks], docs)
+        for c in chunks:
+            if c["id"] in dup_of:
+                c["dup_of"] = dup_of[c["id"]]
+        # 已存在的id内容相同，不重新embedding
+        new_docs = [doc for doc in docs if doc.id not in old_ids]
+        # 中断前已写入的batch不再upsert，但关键词索引可能没来得及保存它们
+        resumed_docs = [doc for doc in docs if doc.id in partial.get(source, ())]
+        return {"source": source, "chunks": chunks, "chars": chars, "old_ids": old_ids, "new_docs": new_docs,
+                "resumed_docs": resumed_docs, "parent_docs": parent_docs, "parent_ids": parent_ids,
+                "tables": file_tables}
+
+    def embed(item):
+        nonlocal embedding_dim
+        texts = [doc.page_content for doc in item["new_docs"]]
+        item["vectors"] = embed_llm.embed_documents(texts) if texts else []
+        if item["vectors"]:
+            embedding_dim = len(item["vectors"][0])
+        return item
+
+    def upsert(item):
+        source, docs, vectors = item["source"], item["new_docs"], item["vectors"]
+        if item["resumed_docs"]:
+            bm25.add([doc.id for doc in item["resumed_docs"]], item["resumed_docs"])
+        for i in range(0, len(docs), UPSERT_BATCH_SIZE):
+            batch = docs[i:i + UPSERT_BATCH_SIZE]
+            ids = upsert_documents(db, batch, vectors[i:i + UPSERT_BATCH_SIZE])
+            by_id = {doc.id: doc for doc in batch}
+            bm25.add(ids, [by_id[i] for i in ids])
+            journal.log(op="batch", source=source, hash=hashes[source], ids=ids)
+        if INDEX_MODE == "parent":
+            parents.replace_source(source, item["parent_ids"], item["parent_docs"])
+        # 表格另存为列式数据供query_table做精确的过滤/聚合，表格在转换进程里随chunk一起抽取
+        if item["tables"] is not None:
+            tables.replace_source(source, item["tables"])
+        stale_ids = list(item["old_ids"] - kept_ids(item))
+        if stale_ids:
+            db.delete(ids=stale_ids)
+            bm25.remove(stale_ids)
+        files[source] = {
+            "hash": hashes[source], "chunks": item["chunks"], "chars": item["chars"],
+            "file_type": os.path.splitext(source)[1].lstrip('.').lower() or 'unknown',
+        }
+        # 没记录file的文件续传时会整个重做
+        save_indexes()
+        journal.log(op="file", source=source, hash=hashes[source], entry=files[source])
+
+    report = Pipeline(
+        "convert", iter_converted_docs(changed, converter), maxsize=INGEST_QUEUE_SIZE
+    ).add(
+        "split", split, count=lambda item: len(item[1])
+    ).add(
+        "embed", embed, count=lambda item: len(item["new_docs"])
+    ).add(
+        "upsert", upsert, count=lambda item: len(item["new_docs"])
+    ).run()
+    print_report(report)
+
+    save_indexes()
+    save_manifest(name, manifest)
+    write_collection_stats(name, manifest, embedding_dim)
+    journal.commit()
+    bump_corpus_version(name)
+    print(f"数据库容量加载后容量：{db._collection.count()}")
+    return report
+
 def crate_vector_database(docs_path, name="chroma_db"):
     # 如果这个数据库已经有了，那
     if os.path.isdir(name):
-        print(f"{name} database already exists !!")
+        print(f"{name} database already exists !! use update_vector_database to sync changes")
         return
-    # 数据处理
-    split_docs = load_raw_docs_and_split(docs_path, converter)
-    for doc in split_docs:
-        # 只保留source字段，删除复杂的dl_meta
-        doc.metadata = {
-            'source': doc.metadata.get('source', 'unknown')
-        }
-    # 初始化空数据库
-    db = init_vector_database(name, embed_llm)
-    print(f"数据库容量加载前容量：{db._collection.count()}")
-    # 加载数据
-    db.add_documents(split_docs)
-    print(f"数据库容量加载后容量：{db._collection.count()}")
+    update_vector_database(docs_path, name)
 
 def vector_database_add_docs(name, docs):
     if not os.path.isdir(name):
         print(f"{name} database is not existing !!")
         return
-    # 数据处理
-    split_docs = load_raw_docs_and_split(docs_path, converter)
-    for doc in split_docs:
-        # 只保留source字段，删除复杂的dl_meta
-        doc.metadata = {
-            'source': doc.metadata.get('source', 'unknown')
-        }
-    # 初始化空数据库
-    db = init_vector_database(name, embed_llm)
-    print(f"数据库容量加载前容量：{db._collection.count()}")
-    # 加载数据
-    db.add_documents(split_docs)
-    print(f"数据库容量加载后容量：{db._collection.count()}")
+    # 只处理新增/修改的文件，不删除其他文件的chunk
+    update_vector_database(docs, name, prune=False)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ingest", action="store_true", help="sync --docs into the database (safe to re-run)")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted ingest")
+    parser.add_argument("--docs", default="./docs")
+    parser.add_argument("--name", default="chroma_db")
+    parser.add_argument("--stats", action="store_true", help="print the collection stats kept by ingest and exit")
+    parser.add_argument("--tables", action="store_true", help="re-extract the table store of every ingested file")
+    args = parser.parse_args()
+
+    if args.stats:
+        stats = read_collection_stats(args.name)
+        if stats is None:
+            print(f"no stats for {args.name}, run --ingest once to create them")
+        else:
+            print(json.dumps(stats, ensure_ascii=False, indent=2))
+        raise SystemExit
+
+    if args.tables:
+        tables = TableStore(args.name)
+        for source in load_manifest(args.name)["files"]:
+            tables.replace_source(source, extract_tables(converter.convert(source).document))
+        print(f"{len(tables.catalog())} tables in {tables.directory}")
+
     # create vector databas (should run once !!!!!)
     # files = get_raw_docs_paths()
     # crate_vector_database(files, "chroma_db")
 
+    # sync changed docs into existing vector database
+    if args.ingest or args.resume:
+        update_vector_database(get_raw_docs_paths(args.docs), args.name, resume=args.resume)
+
     # test vector database
-    db = init_vector_database("chroma_db", embed_llm)
+    db = init_vector_database(args.name, embed_llm)
     res = db.similarity_search("主要竞争对手的市场份额怎么样？", k=5)
     for i,r in enumerate(res):
         print(f"==== chunk {i + 1} from {r.metadata['source']}====")
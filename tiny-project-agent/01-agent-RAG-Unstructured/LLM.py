@@ -1,9 +1,278 @@
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
 from langchain_openai import ChatOpenAI,OpenAIEmbeddings
 from dotenv import load_dotenv
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, one process per cache directory
+    fcntl = None
 
 load_dotenv()
 
+# embedding vectors are cached here, one sub directory per embedding model
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "embed_cache")
+# texts per embedding request: a number, or "auto" to tune it while ingesting
+EMBED_BATCH_SIZE = os.getenv("EMBED_BATCH_SIZE", "auto")
+
+class AdaptiveBatchSize:
+    """AIMD tuning of the embedding batch size, persisted per model and endpoint.
+
+    A failed request halves the batch and retries it; a successful one grows the
+    batch by `step` as long as throughput (texts/s) keeps up with the best seen,
+    otherwise it falls back to the best size. The smallest size that failed is a
+    ceiling the batch stays below; only after `probe_after` successful requests
+    in a row is the ceiling raised by `step`, so a failing size (each failure can
+    cost a full request timeout) is retried rarely instead of every few batches.
+    """
+
+    def __init__(self, key, path, initial=20, min_size=1, max_size=512, step=4, probe_after=100):
+        self.key = key
+        self.path = path
+        self.min_size = min_size
+        self.max_size = max_size
+        self.step = step
+        self.probe_after = probe_after
+        self.requests = 0
+        self.errors = 0
+        self.successes = 0  # successful requests since the last failure or ceiling raise
+        learned = self._load().get(key, {})
+        self.ceiling = learned.get("ceiling", max_size + 1)
+        self.size = min(learned.get("size", initial), self.ceiling - 1)
+        self.best_size = self.size
+        self.best_throughput = learned.get("texts_per_s", 0.0)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        data = self._load()
+        data[self.key] = {
+            "size": self.best_size,
+            "texts_per_s": round(self.best_throughput, 2),
+            "error_rate": round(self.errors / max(self.requests, 1), 4),
+            "ceiling": self.ceiling,
+        }
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def observe(self, n_texts, seconds):
+        throughput = n_texts / max(seconds, 1e-6)
+        self.successes += 1
+        if self.successes >= self.probe_after and self.ceiling <= self.max_size:
+            self.ceiling += self.step  # slow decay: probe a little closer to the size that failed
+            self.successes = 0
+        if n_texts < self.size:
+            return  # last partial batch says nothing about this size
+        if throughput >= self.best_throughput * 0.9:
+            if throughput > self.best_throughput:
+                self.best_throughput, self.best_size = throughput, self.size
+            # additive increase, never up to a size that failed
+            self.size = min(self.max_size, self.size + self.step, self.ceiling - 1)
+        else:
+            self.size = self.best_size
+
+    def run(self, texts, embed_fn):
+        with self._lock:
+            return self._run(texts, embed_fn)
+
+    def _run(self, texts, embed_fn):
+        vectors, i = [], 0
+        while i < len(texts):
+            batch = texts[i:i + self.size]
+            start = time.perf_counter()
+            self.requests += 1
+            try:
+                result = embed_fn(batch)
+            except Exception as e:
+                self.errors += 1
+                self.ceiling = min(self.ceiling, len(batch))
+                self.successes = 0
+                if self.size <= self.min_size:
+                    raise
+                self.size = max(self.min_size, self.size // 2)  # multiplicative decrease
+                # re-measure from the smaller size, additive increase probes upwards again
+                self.best_size, self.best_throughput = self.size, 0.0
+                print(f"embed batch of {len(batch)} failed ({e}), retry with {self.size}")
+                continue
+            self.observe(len(batch), time.perf_counter() - start)
+            vectors.extend(result)
+            i += len(batch)
+        self.save()
+        return vectors
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only calls the server for texts it has never embedded.
+
+    Vectors are keyed by (model name, text hash) and stored in an append-only
+    float32 file read through a memory map; index.tsv maps each key to its row.
+    """
+
+    def __init__(self, embeddings, cache_dir=EMBED_CACHE_DIR, batch_size=EMBED_BATCH_SIZE):
+        self.embeddings = embeddings
+        self.model = embeddings.model
+        self.directory = os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", self.model))
+        self.batcher = None
+        if batch_size == "auto":
+            self.batcher = AdaptiveBatchSize(
+                key=f"{self.model}@{embeddings.openai_api_base}",
+                path=os.path.join(cache_dir, "batch_size.json"),
+                initial=embeddings.chunk_size,
+            )
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.index_path = os.path.join(self.directory, "index.tsv")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._dim = None
+        self._mmap = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def __getattr__(self, name):
+        # model_name, openai_api_base ... come from the wrapped embeddings
+        return getattr(self.embeddings, name)
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _read_dim(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                header = f.readline().split()
+        except OSError:
+            return None
+        return int(header[1]) if len(header) == 2 and header[0] == "#dim" else None
+
+    def _lock_file(self, f):
+        # serializes appends of every process sharing the cache (main.py + an ingest)
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _drop_partial_row(self, f):
+        """Cut a torn trailing row (crash mid-write) off the open vectors file, return the row count."""
+        row_bytes = self._dim * 4
+        size = os.fstat(f.fileno()).st_size
+        if size % row_bytes:
+            print(f"embed cache: dropping {size % row_bytes} bytes of a partially written vector")
+            f.truncate(size - size % row_bytes)
+        return size // row_bytes
+
+    def _load_index(self):
+        if not os.path.isfile(self.index_path):
+            return
+        self._dim = self._read_dim()
+        if self._dim and os.path.isfile(self.vectors_path):
+            with open(self.vectors_path, "r+b") as f:
+                self._lock_file(f)
+                self._drop_partial_row(f)
+        with open(self.index_path, encoding="utf-8") as f:
+            f.readline()  # "#dim N" header
+            for line in f:
+                parts = line.split("\t")
+                if len(parts) == 2 and parts[1].endswith("\n"):  # skip a torn last line
+                    self._rows[parts[0]] = int(parts[1])
+        # vectors are appended before the index, so every indexed row must exist
+        n_rows = self._n_rows()
+        self._rows = {k: r for k, r in self._rows.items() if r < n_rows}
+
+    def _n_rows(self):
+        if not self._dim or not os.path.isfile(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self._dim * 4)
+
+    def _vectors(self):
+        n_rows = self._n_rows()
+        if self._mmap is None or self._mmap.shape[0] != n_rows:
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self._dim))
+        return self._mmap
+
+    def _append(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with open(self.vectors_path, "ab") as f:
+            self._lock_file(f)  # released when the file is closed
+            if self._dim is None:
+                # another process may have created the cache since we loaded it
+                self._dim = self._read_dim()
+                if self._dim is None:
+                    self._dim = vectors.shape[1]
+                    with open(self.index_path, "w", encoding="utf-8") as idx:
+                        idx.write(f"#dim {self._dim}\n")
+            if vectors.shape[1] != self._dim:
+                raise ValueError(f"embedding dim {vectors.shape[1]} != cached dim {self._dim}, clear {self.directory}")
+            # the row number comes from the aligned end of the file, read under the lock
+            start = self._drop_partial_row(f)
+            f.write(vectors.tobytes())
+            f.flush()
+            with open(self.index_path, "a", encoding="utf-8") as idx:
+                for i, key in enumerate(keys):
+                    idx.write(f"{key}\t{start + i}\n")
+                    self._rows[key] = start + i
+
+    def _lookup(self, texts):
+        keys = [self._key(t) for t in texts]
+        with self._lock:
+            missing = {k: t for k, t in zip(keys, texts) if k not in self._rows}
+        self.hits += len(keys) - sum(k in missing for k in keys)
+        self.misses += sum(k in missing for k in keys)
+        return keys, missing
+
+    def _collect(self, keys, missing, vectors):
+        if not keys:
+            return []  # a new cache has no vectors file to map yet
+        with self._lock:
+            if missing:
+                self._append(list(missing), vectors)
+            matrix = self._vectors()
+            return [matrix[self._rows[k]].tolist() for k in keys]
+
+    def _embed(self, texts, embed_fn):
+        keys, missing = self._lookup(texts)
+        vectors = embed_fn(list(missing.values())) if missing else None
+        return self._collect(keys, missing, vectors)
+
+    async def _aembed(self, texts, aembed_fn):
+        keys, missing = self._lookup(texts)
+        vectors = await aembed_fn(list(missing.values())) if missing else None
+        return self._collect(keys, missing, vectors)
+
+    def _embed_batched(self, texts):
+        # only ingest-sized calls tune the batch size; a handful of query variants
+        # (CachedRetriever.embed_queries) goes out as one request and never rewrites batch_size.json
+        if self.batcher is None:
+            return self.embeddings.embed_documents(texts)
+        if len(texts) < self.batcher.size:
+            return self.embeddings.embed_documents(texts, chunk_size=len(texts))
+        return self.batcher.run(texts, lambda batch: self.embeddings.embed_documents(batch, chunk_size=len(batch)))
+
+    def embed_documents(self, texts):
+        return self._embed(texts, self._embed_batched)
+
+    def embed_query(self, text):
+        return self._embed([text], lambda ts: [self.embeddings.embed_query(ts[0])])[0]
+
+    # async variants use the wrapped client's async HTTP calls and never block the event loop
+    async def aembed_documents(self, texts):
+        return await self._aembed(texts, self.embeddings.aembed_documents)
+
+    async def aembed_query(self, text):
+        async def embed_one(ts):
+            return [await self.embeddings.aembed_query(ts[0])]
+        return (await self._aembed([text], embed_one))[0]
+
 chat_llm = ChatOpenAI(
     model=os.getenv("CHAT_MODEL"),
     api_key=os.getenv("CHAT_MODEL_API_KEY"),  # local deploy model
@@ -16,15 +285,17 @@ vl_llm = ChatOpenAI(
     base_url=os.getenv("BASE_URL"),
 )
 
-embed_llm = OpenAIEmbeddings(
+embed_llm = CachedEmbeddings(OpenAIEmbeddings(
     model=os.getenv("EMBED_MODEL"),
     api_key=os.getenv("EMBED_MODEL_API_KEY"),  # local deploy model
     base_url=os.getenv("BASE_URL"),
     check_embedding_ctx_length=False,  # Must !!!
-    chunk_size=20,  # batch process documents 's embed and store
-)
+    # batch process documents 's embed and store (start value when EMBED_BATCH_SIZE=auto)
+    chunk_size=20 if EMBED_BATCH_SIZE == "auto" else int(EMBED_BATCH_SIZE),
+))
 
 
 if __name__ == "__main__":
     print(chat_llm.model_name) # ministral-3-3b-instruct-2512
-    print(chat_llm.openai_api_base) # http://127.0.0.1:1234/v1/
\ No newline at end of file
+    print(chat_llm.openai_api_base) # http://127.0.0.1:1234/v1/
+    print(f"embed cache: {len(embed_llm._rows)} vectors in {embed_llm.directory}")
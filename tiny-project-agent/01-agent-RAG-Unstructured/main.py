@@ -1,8 +1,17 @@
 from langchain.agents import create_agent
 from langchain.tools import tool
+from langchain_core.tools import StructuredTool
 from CustomConverter import converter
-from CustomVectorDB import init_vector_database
+from CustomVectorDB import INDEX_MODE, init_vector_database
+from CustomRetriever import CachedRetriever, aexpand_query, check_filter, expand_query, read_corpus_version
+from CustomAnswerCache import SemanticAnswerCache
+from CustomPacker import pack_context, serialize_context
+from CustomParentStore import PARENT_FANOUT, ParentStore, expand_to_parents
+from CustomTableStore import TableStore
 from LLM import chat_llm, embed_llm
+from typing import Optional
+import asyncio
+import json
 import os
 
 # install first: uv add langchain-docling langchain_openai langchain_text_splitters
@@ -14,19 +23,105 @@ def get_raw_docs_paths(dpath='./docs'):
 # 1. init vector database
 vdb = init_vector_database("chroma_db", embed_llm=embed_llm)
 print(f"vector database loaded {vdb._collection.count()} pieces sub-chunks")
+# hybrid (vector + BM25) search, repeated questions are served from an LRU cache until the next ingest
+retriever = CachedRetriever(
+    vdb, "chroma_db", embed_llm,
+    maxsize=int(os.getenv("RETRIEVE_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("RETRIEVE_CACHE_TTL", 3600)),
+)
+# INDEX_MODE=parent: small child chunks are searched, their parent chunks are returned
+parent_store = ParentStore("chroma_db")
 
 # 2. define retrieve tool
-@tool(response_format="content_and_artifact")
-def retrieve_context(query: str):
-    """Retrieve information to help answer a query."""
-    print("tool search keyword", query)
-    retrieved_docs = vdb.similarity_search(query, k=int(os.getenv("RETRIVE_TOP_N"))) # retrive n most related docs
-    serialized = "\n\n".join(
-        (f"Source: {doc.metadata}\nContent: {doc.page_content}")
-        for doc in retrieved_docs
-    )
+# sync for the chat loop below, async (non-blocking) when the agent runs under langgraph dev / an asyncio server
+RETRIEVE_MAX_CONCURRENCY = int(os.getenv("RETRIEVE_MAX_CONCURRENCY", 16))
+retrieve_slots = asyncio.Semaphore(RETRIEVE_MAX_CONCURRENCY)
+
+def _retrieve_context(query: str, filter: Optional[dict] = None):
+    """Retrieve information to help answer a query.
+
+    Args:
+        query: what to search for.
+        filter: optional metadata filter to narrow the search, e.g. {"file_type": "pdf"},
+            {"source": "./docs/product_catalog.pdf"}, {"page": {"$gte": 2}} or {"headings": "..."}.
+            Fields: source, file_type, headings (exact strings) and page (integer).
+            Operators: $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte (the last four only on page);
+            $and / $or combine filters. file_type is one of md, pdf, png, docx, xlsx, pptx.
+    """
+    print("tool search keyword", query, filter or "")
+    if filter:
+        try:
+            check_filter(filter)
+        except ValueError as e:
+            return f"Error: {e}", []
+    k = int(os.getenv("RETRIVE_TOP_N"))
+    # MULTI_QUERY_N > 0: rewrites of the query are searched concurrently and fused, in one tool call
+    queries = expand_query(chat_llm, query)
+    if INDEX_MODE == "parent":
+        children = retriever.multi_search(queries, k=k * PARENT_FANOUT, filter=filter)
+        retrieved_docs = expand_to_parents(parent_store, children, k)
+    else:
+        retrieved_docs = retriever.multi_search(queries, k=k, filter=filter) # retrive n most related docs
+    # neighbouring chunks are merged without their overlap and the whole context fits CONTEXT_MAX_TOKENS
+    serialized = serialize_context(pack_context(retrieved_docs))
     return serialized, retrieved_docs
 
+async def _aretrieve_context(query: str, filter: Optional[dict] = None):
+    # at most RETRIEVE_MAX_CONCURRENCY retrievals in flight, the rest wait without blocking the loop
+    async with retrieve_slots:
+        print("tool search keyword", query, filter or "")
+        if filter:
+            try:
+                check_filter(filter)
+            except ValueError as e:
+                return f"Error: {e}", []
+        k = int(os.getenv("RETRIVE_TOP_N"))
+        queries = await aexpand_query(chat_llm, query)
+        if INDEX_MODE == "parent":
+            children = await retriever.amulti_search(queries, k=k * PARENT_FANOUT, filter=filter)
+            retrieved_docs = await asyncio.to_thread(expand_to_parents, parent_store, children, k)
+        else:
+            retrieved_docs = await retriever.amulti_search(queries, k=k, filter=filter)
+        serialized = serialize_context(pack_context(retrieved_docs))
+        return serialized, retrieved_docs
+
+retrieve_context = StructuredTool.from_function(
+    func=_retrieve_context,
+    coroutine=_aretrieve_context,
+    name="retrieve_context",
+    response_format="content_and_artifact",
+)
+
+# tables of the ingested documents (xlsx sheets, tables in docx/pptx/pdf) as numpy columns
+table_store = TableStore("chroma_db")
+
+@tool
+def query_table(table: Optional[str] = None, where: Optional[dict] = None, group_by: Optional[str] = None,
+                aggregate: Optional[dict] = None, columns: Optional[list] = None, limit: int = 20):
+    """Exact filters and aggregations over the tables found in company documents.
+
+    Use it for numeric questions (totals, averages, maxima, counts) instead of reading table text.
+    Call it without `table` first to list the tables with their source, columns and row count.
+
+    Args:
+        table: table id from the list.
+        where: row filter on column values, e.g. {"月份": {"$in": ["2024-07", "2024-08", "2024-09"]}},
+            {"销售额": {"$gt": 1000}}, {"产品": {"$contains": "牛奶"}}; $and / $or combine filters.
+        group_by: column to group by before aggregating.
+        aggregate: column -> sum, mean, min, max, count or nunique, e.g. {"销售额": "sum"}.
+        columns: columns to return when not aggregating (default all).
+        limit: max rows (or groups) returned.
+    """
+    print("tool query table", table, where or "", group_by or "", aggregate or "")
+    if table is None:
+        return json.dumps(table_store.catalog(), ensure_ascii=False)
+    try:
+        result = table_store.query(table, where=where, group_by=group_by, aggregate=aggregate,
+                                   columns=columns, limit=limit)
+    except ValueError as e:
+        return f"Error: {e}"
+    return json.dumps(result, ensure_ascii=False)
+
 # 3. create agent
 agent = create_agent(
     model=chat_llm,
@@ -37,8 +132,16 @@ agent = create_agent(
         IMPORTANT: Always use the retrieve_context tool to find accurate information \
         from company documents before answering any questions about \
         company details, contact information, products, or services. \
+        For numbers from tables (sales totals, averages, counts), use the query_table tool. \
         Never make up contact information or company details.",
-    tools=[retrieve_context]
+    tools=[retrieve_context, query_table]
+)
+
+# 4. semantic answer cache: paraphrases of an answered question skip the agent entirely
+answer_cache = SemanticAnswerCache(
+    os.path.join("chroma_db", "answer_cache.jsonl"), embed_llm,
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.92)),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", 86400)),
 )
 
 if __name__ == "__main__":
@@ -48,12 +151,28 @@ if __name__ == "__main__":
     while True:
         ask = input("\n🙋 Me: ").strip()
         if ask.lower() in ['quit', 'exit', 'bye']: break
+        if ask.lower() == 'stats':
+            print(retriever.stats(), answer_cache.stats())
+            continue
         print("🤖 Robot: ", end="", flush=True)
+        version = read_corpus_version("chroma_db")
+        cached, similarity = answer_cache.lookup(ask, version)
+        if cached is not None:
+            print(f"(cached, similarity {similarity:.3f})\n{cached}")
+            continue
+        answer = ""
         for token, metadata in agent.stream({"messages": ask}, stream_mode="messages"):
             node = metadata.get("langgraph_node", "")
             # extract used file
-            if node == "tools" and token.content:
-                chunks = re.split("\n\n", token.content)
+            if node == "tools" and token.content and token.name == "query_table":
+                answer = ""
+                print(f"\n===== Table query =====\n{token.content}")
+            elif node == "tools" and token.content.startswith("Error: "):
+                answer = ""  # a rejected filter, the model retries with a corrected one
+                print(f"\n===== Search error =====\n{token.content}")
+            elif node == "tools" and token.content:
+                answer = ""  # text before a tool call is not the final answer
+                chunks = re.split("\n\n(?=Source: )", token.content)
                 files = [re.search("'source': './docs/(.*?)'", i).group(1) for i in chunks]
                 contents = [re.search("Content: ([\s\S]*)", i).group(1) for i in chunks]
                 for i,(f,c) in enumerate(zip(files,contents)):
@@ -62,7 +181,10 @@ if __name__ == "__main__":
             # print response
             elif node == "model" and token.content:               
                 print(token.content, end="", flush=True)
+                answer += token.content
         print()  
+        if answer:
+            answer_cache.store(ask, answer, version)
 
 """
 🙋 Me: 我们公司的牛奶多少钱
@@ -1,10 +1,27 @@
 """
-测试已加载的向量数据库
+测试已加载的向量数据库 + 检索基准
+
+    python test/test_vector_db.py                 # 查看数据库内容
+    python test/test_vector_db.py --bench --out bench.json
 """
 
-from MyModels import embed_llm
-from langchain_chroma import Chroma
+import argparse
+import json
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LLM import embed_llm
+from CustomRetriever import BM25_FILE, hybrid_search, load_bm25_index
+from CustomFlatIndex import FlatVectorStore
+from CustomVectorDB import read_collection_stats, iter_collection
+from langchain_chroma import Chroma
+import numpy as np
+
+# 标注集: 查询 -> 应该命中的源文件
+QUERIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_queries.json")
 
 def test_vector_database(db_path="chroma_db"):
     """测试向量数据库"""
@@ -73,15 +90,21 @@ def test_vector_database(db_path="chroma_db"):
 
     # 6. 统计信息
     print("\n=== 统计信息 ===")
-    all_data = vector_store._collection.get(include=['metadatas'])
-    sources = {}
-    for metadata in all_data['metadatas']:
-        source = metadata.get('source', '未知')
-        if '.' in source:
-            file_type = source.split('.')[-1]
-        else:
-            file_type = 'unknown'
-        sources[file_type] = sources.get(file_type, 0) + 1
+    stats = read_collection_stats(db_path)
+    if stats is not None:
+        # 入库时维护的统计表，不扫描collection
+        sources = stats["file_types"]
+        print(f"源文件数: {stats['total_sources']}, 总字符数: {stats['total_chars']}, 向量维度: {stats['embedding_dim']}")
+    else:
+        # 旧数据库没有统计表，分页扫描一次
+        sources = {}
+        for _, metadata in iter_collection(vector_store):
+            source = metadata.get('source', '未知')
+            if '.' in source:
+                file_type = source.split('.')[-1]
+            else:
+                file_type = 'unknown'
+            sources[file_type] = sources.get(file_type, 0) + 1
 
     print("按文件类型统计:")
     for file_type, count in sources.items():
@@ -102,6 +125,173 @@ def test_vector_database(db_path="chroma_db"):
     except:
         pass
 
+def load_labeled_queries(path=QUERIES_FILE):
+    with open(path, encoding="utf-8") as f:
+        return [(q["query"], q["expected_sources"]) for q in json.load(f)]
+
+def score_results(docs, expected):
+    """(recall@k over expected source files, reciprocal rank of the first relevant chunk)"""
+    sources = [os.path.basename(doc.metadata.get('source', '')) for doc in docs]
+    recall = len(set(sources) & set(expected)) / len(expected)
+    rank = next((i + 1 for i, s in enumerate(sources) if s in expected), None)
+    return recall, 1.0 / rank if rank else 0.0
+
+def result_keys(docs):
+    return [(doc.metadata.get('source', ''), doc.page_content) for doc in docs]
+
+def overlap_at_k(docs, exact):
+    """share of the exact (flat float32) top-k that the retriever also returned"""
+    return len(set(result_keys(docs)) & set(exact)) / len(exact) if exact else 1.0
+
+def chroma_bytes(db_path):
+    """(HNSW segment bytes, HNSW + chroma.sqlite3 bytes)"""
+    hnsw = 0
+    for name in os.listdir(db_path):
+        segment = os.path.join(db_path, name)
+        if os.path.isfile(os.path.join(segment, "header.bin")):
+            hnsw += sum(os.path.getsize(os.path.join(segment, f)) for f in os.listdir(segment))
+    return hnsw, hnsw + os.path.getsize(os.path.join(db_path, "chroma.sqlite3"))
+
+def flat_bytes(store):
+    """(bytes the scan reads: vectors or quantized codes, bytes of every file this configuration uses)"""
+    files = store.file_sizes()
+    scanned = {"none": ["vectors.bin"], "int8": ["int8.bin", "int8_scale.npy"], "binary": ["binary.bin"]}
+    unused = [name for mode, names in scanned.items() if mode not in ("none", store.quantization) for name in names]
+    return (sum(files.get(name, 0) for name in scanned[store.quantization]),
+            sum(size for name, size in files.items() if name not in unused))
+
+def build_retrievers(db_path):
+    """name -> (params, search(query_text, query_vector, k), sizes() -> (index_bytes, disk_bytes))
+    for every index configuration"""
+    chroma = Chroma(
+        collection_name="db1",
+        embedding_function=embed_llm,
+        persist_directory=db_path,
+    )
+    bm25 = load_bm25_index(chroma, db_path)
+    n_chunks = chroma._collection.count()
+    flat_path = db_path + "_flat"
+
+    bm25_bytes = os.path.getsize(os.path.join(db_path, BM25_FILE))
+    retrievers = {
+        "chroma": (
+            {"backend": "chroma"},
+            lambda q, v, k: chroma.similarity_search_by_vector(v, k=k),
+            lambda: chroma_bytes(db_path),
+        ),
+        "chroma+bm25": (
+            {"backend": "chroma", "hybrid": True},
+            lambda q, v, k: hybrid_search(chroma, bm25, q, k=k),
+            lambda: tuple(n + bm25_bytes for n in chroma_bytes(db_path)),
+        ),
+    }
+    # flat 索引直接从 chroma 拷贝向量，不重新 embedding
+    for dtype, path in [("float32", flat_path), ("float16", flat_path + "_f16")]:
+        store = FlatVectorStore(path, embed_llm, dtype=dtype)
+        if store.count() != n_chunks:
+            store.import_collection(chroma._collection)
+        retrievers[f"flat-{dtype}"] = (
+            {"backend": "flat", "dtype": dtype},
+            lambda q, v, k, store=store: store.similarity_search_by_vector(v, k=k),
+            lambda store=store: flat_bytes(store),
+        )
+    for mode, factors in {"int8": [2, 4], "binary": [10, 20, 40]}.items():
+        for factor in factors:
+            store = FlatVectorStore(flat_path, embed_llm, quantization=mode, rerank_factor=factor)
+            retrievers[f"flat-{mode}-x{factor}"] = (
+                {"backend": "flat", "quantization": mode, "rerank_factor": factor},
+                lambda q, v, k, store=store: store.similarity_search_by_vector(v, k=k),
+                lambda store=store: flat_bytes(store),
+            )
+    return retrievers, n_chunks
+
+def benchmark_retriever(search, queries, vectors, k, repeat=5, concurrency=8, exact=None):
+    """exact: per query the result keys of the exact flat float32 top-k, for overlap@k"""
+    recalls, rrs, overlaps, latencies = [], [], [], []
+    for i, ((query, expected), vector) in enumerate(zip(queries, vectors)):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            docs = search(query, vector, k)
+            latencies.append((time.perf_counter() - start) * 1000)
+        recall, rr = score_results(docs, expected)
+        recalls.append(recall)
+        rrs.append(rr)
+        if exact is not None:
+            overlaps.append(overlap_at_k(docs, exact[i]))
+
+    # QPS: 并发线程反复执行全部查询
+    jobs = [(q, v) for (q, _), v in zip(queries, vectors)] * repeat
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda job: search(job[0], job[1], k), jobs))
+    qps = len(jobs) / (time.perf_counter() - start)
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "recall@k": round(float(np.mean(recalls)), 4),
+        "mrr": round(float(np.mean(rrs)), 4),
+        # 与精确检索 (flat float32) top-k 的重合率，量化/近似索引丢了多少真正的近邻
+        "overlap@k": round(float(np.mean(overlaps)), 4) if overlaps else None,
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "qps": round(qps, 1),
+    }
+
+def run_benchmark(db_path="chroma_db", ks=(1, 3, 5, 10), repeat=5, concurrency=8, queries_file=QUERIES_FILE):
+    """Sweep k and index configurations, return a JSON-serializable report."""
+    queries = load_labeled_queries(queries_file)
+    vectors = embed_llm.embed_documents([q for q, _ in queries])  # 查询向量预先算好，只测检索
+    retrievers, n_chunks = build_retrievers(db_path)
+    exact_search = retrievers["flat-float32"][1]
+    exact = {k: [result_keys(exact_search(q, v, k)) for (q, _), v in zip(queries, vectors)] for k in ks}
+    results = []
+    for name, (params, search, sizes) in retrievers.items():
+        rows = []
+        for k in ks:
+            metrics = benchmark_retriever(search, queries, vectors, k, repeat, concurrency, exact[k])
+            rows.append({"retriever": name, "params": params, "k": k, **metrics})
+            print(f"{name:<18} k={k:<3} recall={metrics['recall@k']:.3f} overlap={metrics['overlap@k']:.3f} "
+                  f"mrr={metrics['mrr']:.3f} p50={metrics['p50_ms']:.2f}ms p95={metrics['p95_ms']:.2f}ms "
+                  f"p99={metrics['p99_ms']:.2f}ms qps={metrics['qps']:.0f}")
+        # 量化码在第一次检索时才生成，跑完再量大小
+        index_bytes, disk_bytes = sizes()
+        print(f"{name:<18} index={index_bytes / 2**20:.2f}MB disk={disk_bytes / 2**20:.2f}MB")
+        results += [dict(row, index_bytes=index_bytes, disk_bytes=disk_bytes) for row in rows]
+    return {
+        "db_path": db_path,
+        "n_chunks": n_chunks,
+        "n_queries": len(queries),
+        "repeat": repeat,
+        "concurrency": concurrency,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
 if __name__ == "__main__":
-    # 测试默认路径
-    test_vector_database("chroma_db")
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default="chroma_db")
+    parser.add_argument("--bench", action="store_true", help="run the retrieval benchmark")
+    parser.add_argument("--k", default=os.getenv("RETRIVE_TOP_N", "1,3,5,10"), help="comma separated k values")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--queries", default=QUERIES_FILE)
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args()
+
+    if not args.bench:
+        test_vector_database(args.db)
+    else:
+        report = run_benchmark(
+            args.db,
+            ks=[int(k) for k in args.k.split(",")],
+            repeat=args.repeat,
+            concurrency=args.concurrency,
+            queries_file=args.queries,
+        )
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=1)
+            print(f"report written to {args.out}")
+        else:
+            print(json.dumps(report, ensure_ascii=False, indent=1))